@@ -0,0 +1,575 @@
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import datetime
+import tempfile
+import threading
+
+import ledger
+import database
+
+SOURCES = ["Salary", "Freelance", "Gift", "Rent", "Food", "Transport", "Bills", "Other"]
+
+def generate_rows(count, users, seed=1):
+    rng = random.Random(seed)
+    first_day = datetime.date(2015, 1, 1).toordinal()
+    last_day = datetime.date(2024, 12, 31).toordinal()
+    for _ in range(count):
+        yield (
+            f"user{rng.randrange(users)}",
+            round(rng.uniform(1, 10000), 2),
+            datetime.date.fromordinal(rng.randint(first_day, last_day)).isoformat(),
+            rng.choice(SOURCES),
+            "generated record",
+            rng.choice(["Cash", "Card"]),
+        )
+
+def time_query(connection, query, params, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        connection.execute(query, params).fetchall()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+def index_queries(username, amount_scale=1):
+    return [
+        ("load_incomes", "SELECT * FROM incomes WHERE username=?", (username,)),
+        ("report_month", "SELECT * FROM incomes WHERE username=? AND date BETWEEN ? AND ?",
+         (username, "2020-03-01", "2020-03-31")),
+        ("report_year", "SELECT * FROM incomes WHERE username=? AND date BETWEEN ? AND ?",
+         (username, "2020-01-01", "2020-12-31")),
+        ("search_amount", "SELECT * FROM incomes WHERE username=? AND amount >= ? AND amount <= ?",
+         (username, 100 * amount_scale, 200 * amount_scale)),
+    ]
+
+def bench_indexes(args):
+    with tempfile.TemporaryDirectory() as directory:
+        connection = sqlite3.connect(os.path.join(directory, "bench.db"))
+        ledger.create_tables(connection)
+        connection.executemany("INSERT INTO incomes VALUES (?, ?, ?, ?, ?, ?)", generate_rows(args.rows, args.users))
+        connection.commit()
+
+        queries = index_queries("user0")
+        before = {name: time_query(connection, query, params, args.repeat) for name, query, params in queries}
+        ledger.migrate(connection)
+        connection.execute("ANALYZE")
+        # the migrations store amounts in cents
+        after = {name: time_query(connection, query, params, args.repeat)
+                 for name, query, params in index_queries("user0", amount_scale=100)}
+        connection.close()
+
+    print(f"{args.rows} rows, {args.users} users, median of {args.repeat} runs")
+    print(f"{'query':<16}{'before (ms)':>14}{'after (ms)':>14}{'speedup':>10}")
+    for name, _, _ in queries:
+        print(f"{name:<16}{before[name] * 1000:>14.3f}{after[name] * 1000:>14.3f}{before[name] / after[name]:>9.1f}x")
+
+def use_database(path, journal_mode=database.JOURNAL_MODE, synchronous=database.SYNCHRONOUS):
+    return database.configure(path, journal_mode=journal_mode, synchronous=synchronous)
+
+def bench_inserts(args):
+    settings = [("DELETE", "FULL"), (database.JOURNAL_MODE, database.SYNCHRONOUS)]
+    print(f"{'journal':<10}{'synchronous':<13}{'mode':<10}{'rows':>10}{'rows/sec':>14}")
+    for journal_mode, synchronous in settings:
+        with tempfile.TemporaryDirectory() as directory:
+            pool = use_database(os.path.join(directory, "bench.db"), journal_mode, synchronous)
+
+            start = time.perf_counter()
+            for row in generate_rows(args.single_rows, args.users):
+                ledger.save_income(row)
+            single = args.single_rows / (time.perf_counter() - start)
+
+            rows = generate_rows(args.rows, args.users, seed=2)
+            start = time.perf_counter()
+            with ledger.transaction():
+                ledger.save_incomes(rows)
+            batched = args.rows / (time.perf_counter() - start)
+            pool.close()
+
+        print(f"{journal_mode:<10}{synchronous:<13}{'single':<10}{args.single_rows:>10}{single:>14,.0f}")
+        print(f"{journal_mode:<10}{synchronous:<13}{'batched':<10}{args.rows:>10}{batched:>14,.0f}")
+
+WORDS = [f"{syllable}{suffix}" for syllable in ("ba", "ko", "mi", "ra", "te", "su", "no", "lé", "fa", "gu")
+         for suffix in ("rin", "dax", "mol", "pet", "zun", "kir", "vos", "tal", "nem", "bis")]
+
+def generate_described_rows(count, users, seed=3):
+    rng = random.Random(seed)
+    for username, amount, date, source, _, type_ in generate_rows(count, users, seed):
+        yield username, amount, date, source, " ".join(rng.choices(WORDS, k=6)), type_
+
+def bench_fts(args):
+    fields = ["source", "description", "type"]
+    with tempfile.TemporaryDirectory() as directory:
+        pool = use_database(os.path.join(directory, "bench.db"))
+        with ledger.transaction():
+            ledger.save_incomes(generate_described_rows(args.rows, args.users))
+        database.execute_query("ANALYZE")
+        connection = pool.acquire_reader()
+
+        print(f"{args.rows} rows, {args.users} users, median of {args.repeat} runs")
+        print(f"{'term':<14}{'matches':>9}{'LIKE (ms)':>12}{'FTS (ms)':>12}{'LIKE page':>12}{'FTS page':>12}{'ranked':>10}")
+        for term in ("barin", "ko", "mimol tepet", "Salary"):
+            timings = {}
+            for full_text in (False, True):
+                query, params = ledger.build_search_query("user0", "incomes", term, fields, full_text=full_text)
+                timings[full_text] = time_query(connection, query, params, args.repeat)
+                query, params = ledger.build_search_query("user0", "incomes", term, fields, columns=ledger.PAGE_COLUMNS,
+                                                        full_text=full_text)
+                timings[full_text, "page"] = time_query(connection, query + " ORDER BY date, id LIMIT ?",
+                                                        params + [ledger.RESULTS_PAGE_SIZE], args.repeat)
+            matches = len(connection.execute(*ledger.build_search_query("user0", "incomes", term, fields)).fetchall())
+
+            start = time.perf_counter()
+            ledger.search_ranked("user0", "incomes", term, fields, limit=20)
+            ranked = time.perf_counter() - start
+
+            print(f"{term:<14}{matches:>9}{timings[False] * 1000:>12.3f}{timings[True] * 1000:>12.3f}"
+                  f"{timings[False, 'page'] * 1000:>12.3f}{timings[True, 'page'] * 1000:>12.3f}{ranked * 1000:>10.3f}")
+        pool.release_reader(connection)
+        pool.close()
+
+def strptime_is_valid_date(date_text):
+    # the validator as it was before ledger.iso_date
+    try:
+        datetime.datetime.strptime(date_text, "%Y-%m-%d")
+        return True
+    except ValueError:
+        return False
+
+def generate_date_texts(count, distinct, seed=4):
+    rng = random.Random(seed)
+    first_day = datetime.date(2015, 1, 1).toordinal()
+    texts = [datetime.date.fromordinal(first_day + day).isoformat() for day in range(distinct)]
+    texts += ["2024-1-5", "2024-02-30", "2024-13-01", "not a date"]
+    return [rng.choice(texts) for _ in range(count)]
+
+def bench_dates(args):
+    values = generate_date_texts(args.values, args.distinct)
+    validators = [
+        ("strptime", strptime_is_valid_date),
+        ("iso_date uncached", lambda text: ledger.iso_date.__wrapped__(text) is not None),
+        ("is_valid_date", ledger.is_valid_date),
+    ]
+    print(f"{args.values} values, {args.distinct} distinct dates, best of {args.repeat} runs")
+    print(f"{'validator':<20}{'values/sec':>14}{'speedup':>10}")
+    baseline = None
+    for name, validator in validators:
+        timings = []
+        for _ in range(args.repeat):
+            ledger.iso_date.cache_clear()
+            start = time.perf_counter()
+            for value in values:
+                validator(value)
+            timings.append(time.perf_counter() - start)
+        rate = args.values / min(timings)
+        baseline = baseline or rate
+        print(f"{name:<20}{rate:>14,.0f}{rate / baseline:>9.1f}x")
+
+def generate_users(count, seed=5):
+    rng = random.Random(seed)
+    cities = ledger.get_cities()
+    for index in range(count):
+        # a third of the emails are from an unaccepted domain; a few phones and passwords are malformed
+        yield (f"user{index}", rng.choice(["Ali", "Sara", "Reza", "Mina"]), rng.choice(["Karimi", "Ahmadi", "Rezaei"]),
+               "09" + "".join(rng.choices("0123456789", k=9 if rng.random() > 0.03 else 8)),
+               rng.choice(["Secret1!", "Passw0rd#", "weak"]) if rng.random() < 0.1 else "Secret1!",
+               rng.choice(cities), rng.choice(["ali@gmail.com", "sara@yahoo.com", "bad@example.org"]),
+               f"{rng.randint(1950, 2004)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}", "", "")
+
+def validate_row_by_row(record_type, records):
+    # each field checked on each row in turn, as the GUI and importer did before validate_records
+    errors = {}
+    for row, record in enumerate(records):
+        for index, field, check, message in ledger.VALIDATION_SCHEMAS[record_type]:
+            if not check(record[index]):
+                errors.setdefault(row, []).append((field, message))
+    return errors
+
+def bench_validation(args):
+    batches = {
+        "incomes": [(username, str(amount), date, source, description, type_)
+                    for username, amount, date, source, description, type_ in generate_rows(args.rows, args.users)],
+        "users": list(generate_users(args.rows)),
+    }
+    print(f"{args.rows} rows per record type, best of {args.repeat} runs")
+    print(f"{'records':<10}{'invalid':>9}{'row by row/s':>16}{'batched/s':>14}{'speedup':>10}")
+    for record_type, records in batches.items():
+        rates = []
+        for validate in (validate_row_by_row, ledger.validate_records):
+            timings = []
+            for _ in range(args.repeat):
+                ledger.iso_date.cache_clear()
+                start = time.perf_counter()
+                errors = validate(record_type, records)
+                timings.append(time.perf_counter() - start)
+            rates.append(args.rows / min(timings))
+        print(f"{record_type:<10}{len(errors):>9}{rates[0]:>16,.0f}{rates[1]:>14,.0f}{rates[1] / rates[0]:>9.1f}x")
+
+def time_logins(username, password, logins, threads):
+    def work():
+        for _ in range(logins // threads):
+            if ledger.authenticate(username, password) is None:
+                raise RuntimeError("login failed")
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return (logins // threads) * threads / (time.perf_counter() - start)
+
+def bench_logins(args):
+    cores = os.cpu_count()
+    default_n = ledger.SCRYPT_N
+    print(f"r={ledger.SCRYPT_R}, p={ledger.SCRYPT_P}, {cores} cores, {args.logins} logins per setting")
+    print(f"{'n':>8}{'memory':>10}{'1 thread/s':>13}{f'{cores} threads/s':>15}{'per core/s':>13}")
+    with tempfile.TemporaryDirectory() as directory:
+        pool = use_database(os.path.join(directory, "bench.db"))
+        try:
+            for exponent in range(args.min_cost, args.max_cost + 1):
+                ledger.SCRYPT_N = 2 ** exponent
+                username = f"user{exponent}"
+                ledger.save_user((username, "A", "B", "09123456789", "Secret1!", "Tehran", "a@gmail.com",
+                                  "1990-01-01", "", ""))
+                single = time_logins(username, "Secret1!", args.logins, 1)
+                threaded = time_logins(username, "Secret1!", args.logins, cores)
+                memory = 128 * ledger.SCRYPT_N * ledger.SCRYPT_R / 2 ** 20
+                print(f"{ledger.SCRYPT_N:>8}{memory:>8.0f}MB{single:>13,.1f}{threaded:>15,.1f}{threaded / cores:>13,.1f}")
+        finally:
+            ledger.SCRYPT_N = default_n
+            pool.close()
+
+    token = ledger.create_session("user")
+    start = time.perf_counter()
+    for _ in range(args.logins * 1000):
+        ledger.session_user(token)
+    print(f"session token lookups: {args.logins * 1000 / (time.perf_counter() - start):,.0f}/s")
+
+BENCH_PASSWORD = "Secret1!"
+INCOME_SOURCES = ["Salary", "Freelance", "Gift", "Other"]
+EXPENSE_CATEGORIES = ["Rent", "Food", "Transport", "Bills", "Health", "Other"]
+GENERATE_BATCH_SIZE = 20_000
+# the fields the search window ticks by default
+SEARCH_FIELDS = ["amount", "date", "source", "description", "type"]
+
+def generate_ledger_records(users, records, start, end, seed=6):
+    rng = random.Random(seed)
+    first_day, last_day = start.toordinal(), end.toordinal()
+    for index in range(users):
+        username = f"user{index}"
+        for _ in range(records):
+            date = datetime.date.fromordinal(rng.randint(first_day, last_day)).isoformat()
+            description = " ".join(rng.choices(WORDS, k=4))
+            type_ = rng.choice(["Cash", "Card"])
+            # about one record in five is an income
+            if rng.random() < 0.2:
+                yield "incomes", (username, round(rng.uniform(100, 5000), 2), date, rng.choice(INCOME_SOURCES),
+                                  description, type_)
+            else:
+                yield "expenses", (username, round(rng.uniform(1, 500), 2), date, rng.choice(EXPENSE_CATEGORIES),
+                                   description, type_)
+
+def generate_ledger(users, records, start, end, seed=6, batch_size=GENERATE_BATCH_SIZE):
+    # fills the configured database with user0..user{users-1}, all with BENCH_PASSWORD; the same seed and
+    # arguments always produce the same records
+    password = ledger.hash_secret(BENCH_PASSWORD)  # shared, so a thousand users cost one scrypt call
+    database.execute_many('''INSERT INTO users (username, first_name, last_name, phone, password, city, email,
+                                                birthdate, security_question, security_answer)
+                             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                          [(f"user{index}", "Bench", "User", "09120000000", password, "Tehran",
+                            f"user{index}@gmail.com", "1990-01-01", "", "") for index in range(users)])
+    savers = {"incomes": ledger.save_incomes, "expenses": ledger.save_expenses}
+    batches = {"incomes": [], "expenses": []}
+    for record_table, row in generate_ledger_records(users, records, start, end, seed):
+        batch = batches[record_table]
+        batch.append(row)
+        if len(batch) >= batch_size:
+            savers[record_table](batch)
+            batch.clear()
+    for record_table, batch in batches.items():
+        if batch:
+            savers[record_table](batch)
+    database.execute_query("ANALYZE")
+
+def run_generate(args):
+    if os.path.exists(args.path):
+        sys.exit(f"{args.path} already exists; generate only fills new databases.")
+    pool = use_database(args.path)
+    start = time.perf_counter()
+    try:
+        generate_ledger(args.users, args.records, args.start, args.end, args.seed)
+    finally:
+        pool.close()
+    print(f"Generated {args.users} users with {args.records} records each in {time.perf_counter() - start:.1f}s.")
+
+def measure(name, func, repeat, rows_per_run=1, warmup=0):
+    # func gets the run number; the statements it runs are tagged with the case name in the metrics.
+    # Untimed warmup runs bring the pages a case reads into the cache first
+    timings = []
+    rows = 0
+    with database.tagged(name):
+        for run in range(warmup):
+            func(run)
+        for run in range(repeat):
+            start = time.perf_counter()
+            rows = func(run)
+            timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    median = timings[len(timings) // 2]
+    return {"name": name, "runs": repeat, "rows": rows, "min_ms": round(timings[0], 4), "median_ms": round(median, 4),
+            "p95_ms": round(timings[min(len(timings) - 1, len(timings) * 95 // 100)], 4),
+            "max_ms": round(timings[-1], 4), "per_sec": round(rows_per_run * 1000 / median, 1) if median else None}
+
+def first_page(query, params):
+    return len(ledger.fetch_page(query, params))
+
+def suite_cases(usernames, start, end, repeat, batch_rows):
+    # reads first, then writes, so every read sees the same data; the report windows are anchored at the end
+    # of the generated span instead of today, which keeps the results comparable from one day to the next
+    pick = lambda run: usernames[run % len(usernames)]
+    warmup = len(usernames)
+    middle = start + (end - start) / 2
+    month_start, month_end = ledger.month_bounds(middle)
+    searches = {
+        "search_term": {"term": WORDS[7]},
+        "search_label": {"term": "Food"},
+        "search_date": {"start_date": str(month_start), "end_date": str(month_end)},
+        "search_amount": {"min_amount": "10", "max_amount": "20"},
+        "search_combined": {"term": WORDS[7], "start_date": str(start), "end_date": str(middle), "min_amount": "10",
+                            "max_amount": "250"},
+    }
+    reports = {
+        "day": (end, end),
+        "month": ledger.month_bounds(end),
+        "year": (end.replace(month=1, day=1), end.replace(month=12, day=31)),
+        "custom": (start, end),
+    }
+    yield measure("login_lookup", lambda run: int(ledger.get_user(pick(run)) is not None), repeat, warmup=warmup)
+    yield measure("login", lambda run: int(ledger.authenticate(pick(run), BENCH_PASSWORD) is not None), repeat,
+                  warmup=warmup)
+    for name, filters in searches.items():
+        fields = SEARCH_FIELDS if "term" in filters else ()
+        yield measure(name, lambda run: first_page(*ledger.build_search_query(
+            pick(run), "expenses", fields=fields, columns=ledger.PAGE_COLUMNS, **filters)), repeat, warmup=warmup)
+    for filter_type, (report_start, report_end) in reports.items():
+        yield measure(f"report_total_{filter_type}", lambda run: int(ledger.report_total(
+            pick(run), "expenses", "custom", str(report_start), str(report_end)) is not None), repeat, warmup=warmup)
+        yield measure(f"report_page_{filter_type}", lambda run: first_page(*ledger.build_report_query(
+            pick(run), "expenses", "custom", str(report_start), str(report_end), columns=ledger.PAGE_COLUMNS)), repeat,
+            warmup=warmup)
+    # the grouped reports the rollups cannot answer: amount bounds or grouping by type
+    yield measure("report_grouped_amount", lambda run: len(ledger.grouped_report(
+        pick(run), start, end, "month", "label", min_amount="10")["periods"]), repeat, warmup=warmup)
+    yield measure("report_grouped_type", lambda run: len(ledger.grouped_report(
+        pick(run), start, end, "year", "type")["periods"]), repeat, warmup=warmup)
+
+    day = str(end)
+    yield measure("save_income", lambda run: ledger.save_income((pick(run), "12.50", day, "Salary", "bench", "Card"))
+                  or 1, repeat)
+    yield measure("save_expense", lambda run: ledger.save_expense((pick(run), "3.75", day, "Food", "bench", "Cash"))
+                  or 1, repeat)
+    batch = [(usernames[0], "3.75", day, "Food", "bench", "Cash")] * batch_rows
+    yield measure("save_expenses_batch", lambda run: ledger.save_expenses(batch) or batch_rows, max(repeat // 4, 1),
+                  rows_per_run=batch_rows)
+
+def dataset_summary():
+    users = database.fetch_one("SELECT COUNT(*) FROM users")[0]
+    incomes, first, last = database.fetch_one("SELECT COUNT(*), MIN(date), MAX(date) FROM incomes")
+    expenses, expense_first, expense_last = database.fetch_one("SELECT COUNT(*), MIN(date), MAX(date) FROM expenses")
+    return {"users": users, "incomes": incomes, "expenses": expenses,
+            "start": min(filter(None, (first, expense_first))), "end": max(filter(None, (last, expense_last)))}
+
+def run_suite(args):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "suite.db")
+        if args.db:
+            # the suite writes, so it runs on a copy and never touches the database it is pointed at
+            source, target = sqlite3.connect(args.db), sqlite3.connect(path)
+            source.backup(target)
+            source.close()
+            target.close()
+        pool = use_database(path)
+        try:
+            if not args.db:
+                generate_ledger(args.users, args.records, args.start, args.end, args.seed)
+            dataset = dataset_summary()
+            start, end = datetime.date.fromisoformat(dataset["start"]), datetime.date.fromisoformat(dataset["end"])
+            usernames = [f"user{index}" for index in range(min(dataset["users"], 10))]
+            if ledger.authenticate(usernames[0], BENCH_PASSWORD) is None:
+                sys.exit("The suite needs a database made by the generate command.")
+            ledger.configure_analytics_cache(int(args.analytics_cache_mb * 2 ** 20))
+            database.reset_metrics()
+            results = list(suite_cases(usernames, start, end, args.repeat, args.batch_rows))
+            report = {
+                "label": args.label,
+                "created": datetime.datetime.now().isoformat(timespec="seconds"),
+                "python": sys.version.split()[0],
+                "sqlite": sqlite3.sqlite_version,
+                "schema_version": database.fetch_one("PRAGMA user_version")[0],
+                "dataset": dataset,
+                "repeat": args.repeat,
+                "analytics_cache_mb": args.analytics_cache_mb,
+                "results": results,
+                "queries": database.metrics_snapshot()["queries"],
+            }
+        finally:
+            pool.close()
+
+    if not args.output:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+        return
+    with open(args.output, "w", encoding="utf-8") as handle:
+        json.dump(report, handle, indent=2)
+    print(f"{dataset['incomes'] + dataset['expenses']} records, {dataset['users']} users, {args.repeat} runs per case")
+    print(f"{'case':<24}{'rows':>7}{'median (ms)':>14}{'p95 (ms)':>12}{'per sec':>12}")
+    for result in results:
+        print(f"{result['name']:<24}{result['rows']:>7}{result['median_ms']:>14.3f}{result['p95_ms']:>12.3f}"
+              f"{result['per_sec'] or 0:>12,.0f}")
+
+def run_compare(args):
+    # exits non-zero when any case's median got slower than threshold times the baseline
+    with open(args.baseline, encoding="utf-8") as handle:
+        baseline = json.load(handle)
+    with open(args.current, encoding="utf-8") as handle:
+        current = json.load(handle)
+    if baseline["dataset"] != current["dataset"]:
+        print("warning: the two runs used different datasets", file=sys.stderr)
+    baseline = {result["name"]: result for result in baseline["results"]}
+    regressions = 0
+    print(f"{'case':<24}{'baseline (ms)':>15}{'current (ms)':>14}{'ratio':>8}")
+    for result in current["results"]:
+        before = baseline.get(result["name"])
+        if before is None or not before["median_ms"]:
+            continue
+        ratio = result["median_ms"] / before["median_ms"]
+        slower = ratio > args.threshold
+        regressions += slower
+        print(f"{result['name']:<24}{before['median_ms']:>15.3f}{result['median_ms']:>14.3f}{ratio:>7.2f}x"
+              f"{'  slower' if slower else ''}")
+    if regressions:
+        sys.exit(f"{regressions} case(s) slower than {args.threshold}x the baseline.")
+
+RECURRING_WINDOWS = {"week": 7, "month": 30, "year": 365}
+
+def bench_recurring(args):
+    # one daily and one monthly rule that have run for each lifetime up to the end of the data; every window
+    # ends there too, so a longer lifetime only adds occurrences before the window
+    with tempfile.TemporaryDirectory() as directory:
+        pool = use_database(os.path.join(directory, "recurring.db"))
+        try:
+            end = datetime.date(2024, 12, 31)
+            generate_ledger(1, args.records, datetime.date(2020, 1, 1), end)
+            print(f"{args.records} records, a daily and a monthly rule per lifetime, median of {args.repeat} runs")
+            print(f"{'lifetime (years)':<18}{'window':<8}{'occurrences':>12}{'total (ms)':>12}{'grouped (ms)':>14}"
+                  f"{'search (ms)':>13}")
+            for years in args.lifetimes:
+                first = end.replace(year=end.year - years) + datetime.timedelta(days=1)
+                rules = [ledger.save_recurring_rule("expenses", ("user0", "4.50", str(first), "Food", "lunch", "Card"),
+                                                    "daily"),
+                         ledger.save_recurring_rule("expenses", ("user0", "800", str(first), "Rent", "rent", "Transfer"),
+                                                    "monthly")]
+                for window, days in RECURRING_WINDOWS.items():
+                    start = end - datetime.timedelta(days=days - 1)
+                    occurrences = sum(len(dates) for _, dates in ledger.recurring_dates("user0", "expenses", start, end))
+                    total = measure("total", lambda run: ledger.report_total(
+                        "user0", "expenses", "custom", str(start), str(end)), args.repeat)
+                    grouped = measure("grouped", lambda run: ledger.grouped_report(
+                        "user0", start, end, "day", "label"), args.repeat)
+                    search = measure("search", lambda run: first_page(*ledger.build_search_query(
+                        "user0", "expenses", "lunch", ["description"], str(start), str(end),
+                        columns=ledger.PAGE_COLUMNS)), args.repeat)
+                    print(f"{years:<18}{window:<8}{occurrences:>12}{total['median_ms']:>12.3f}"
+                          f"{grouped['median_ms']:>14.3f}{search['median_ms']:>13.3f}")
+                for rule_id in rules:
+                    ledger.delete_recurring_rule("user0", rule_id)
+        finally:
+            pool.close()
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="Finance manager benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    indexes = subparsers.add_parser("indexes", help="query latency before and after the schema migrations")
+    indexes.add_argument("--rows", type=int, default=1_000_000)
+    indexes.add_argument("--users", type=int, default=500)
+    indexes.add_argument("--repeat", type=int, default=5)
+    indexes.set_defaults(func=bench_indexes)
+
+    inserts = subparsers.add_parser("inserts", help="rows/sec for save_income vs batched save_incomes")
+    inserts.add_argument("--rows", type=int, default=200_000)
+    inserts.add_argument("--single-rows", type=int, default=2_000)
+    inserts.add_argument("--users", type=int, default=500)
+    inserts.set_defaults(func=bench_inserts)
+
+    fts = subparsers.add_parser("fts", help="search latency for the LIKE path vs the full-text index")
+    fts.add_argument("--rows", type=int, default=1_000_000)
+    fts.add_argument("--users", type=int, default=50)
+    fts.add_argument("--repeat", type=int, default=5)
+    fts.set_defaults(func=bench_fts)
+
+    dates = subparsers.add_parser("dates", help="date validation throughput, strptime vs the cached parser")
+    dates.add_argument("--values", type=int, default=1_000_000)
+    dates.add_argument("--distinct", type=int, default=3650)
+    dates.add_argument("--repeat", type=int, default=3)
+    dates.set_defaults(func=bench_dates)
+
+    validation = subparsers.add_parser("validation", help="rows/sec for row-by-row vs batched validation")
+    validation.add_argument("--rows", type=int, default=1_000_000)
+    validation.add_argument("--users", type=int, default=500)
+    validation.add_argument("--repeat", type=int, default=3)
+    validation.set_defaults(func=bench_validation)
+
+    logins = subparsers.add_parser("logins", help="logins/sec per core at each scrypt cost")
+    logins.add_argument("--logins", type=int, default=40)
+    logins.add_argument("--min-cost", type=int, default=12, help="smallest log2(n) to try")
+    logins.add_argument("--max-cost", type=int, default=16, help="largest log2(n) to try")
+    logins.set_defaults(func=bench_logins)
+
+    recurring = subparsers.add_parser("recurring", help="report and search latency by rule lifetime and query window")
+    recurring.add_argument("--records", type=int, default=10_000)
+    recurring.add_argument("--lifetimes", type=int, nargs="+", default=[1, 10, 50], help="years each rule has run")
+    recurring.add_argument("--repeat", type=int, default=20)
+    recurring.set_defaults(func=bench_recurring)
+
+    generate = subparsers.add_parser("generate", help="fill a new database with synthetic users and records")
+    generate.add_argument("path")
+    generate.add_argument("--users", type=int, default=100)
+    generate.add_argument("--records", type=int, default=10_000, help="records per user")
+    generate.add_argument("--start", type=datetime.date.fromisoformat, default=datetime.date(2020, 1, 1))
+    generate.add_argument("--end", type=datetime.date.fromisoformat, default=datetime.date(2024, 12, 31))
+    generate.add_argument("--seed", type=int, default=6)
+    generate.set_defaults(func=run_generate)
+
+    suite = subparsers.add_parser("suite", help="time login, inserts, search and reports and write the results as JSON")
+    suite.add_argument("--db", help="a database made by generate (default: generate one from the options below)")
+    suite.add_argument("--users", type=int, default=20)
+    suite.add_argument("--records", type=int, default=5_000, help="records per user")
+    suite.add_argument("--start", type=datetime.date.fromisoformat, default=datetime.date(2020, 1, 1))
+    suite.add_argument("--end", type=datetime.date.fromisoformat, default=datetime.date(2024, 12, 31))
+    suite.add_argument("--seed", type=int, default=6)
+    suite.add_argument("--repeat", type=int, default=20)
+    suite.add_argument("--batch-rows", type=int, default=1_000, help="rows per save_expenses batch")
+    suite.add_argument("--analytics-cache-mb", type=float, default=0, help="run with the analytics cache on")
+    suite.add_argument("--label", help="stored in the results, e.g. a version or commit")
+    suite.add_argument("--output", help="write the JSON here and print a summary (default: JSON to stdout)")
+    suite.set_defaults(func=run_suite)
+
+    compare = subparsers.add_parser("compare", help="compare two suite results and fail on regressions")
+    compare.add_argument("baseline")
+    compare.add_argument("current")
+    compare.add_argument("--threshold", type=float, default=1.5,
+                         help="slowdown ratio of the medians that counts as a regression (default: %(default)s)")
+    compare.set_defaults(func=run_compare)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+if __name__ == "__main__":
+    main_cli(sys.argv[1:])
@@ -0,0 +1,445 @@
+import re
+import json
+import time
+import queue
+import bisect
+import sqlite3
+import datetime
+import functools
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+DATABASE_PATH = "finance_manager.db"
+JOURNAL_MODE = "WAL"
+SYNCHRONOUS = "NORMAL"
+# only takes effect on a database that has no tables yet, or at its next VACUUM
+AUTO_VACUUM = "INCREMENTAL"
+BUSY_TIMEOUT = 30
+READ_POOL_SIZE = 4
+STATEMENT_CACHE_SIZE = 256
+
+SLOW_QUERY_MS = 100
+SLOW_QUERY_LOG_SIZE = 100
+# upper bounds of the latency histogram buckets; one more bucket counts everything slower
+LATENCY_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+UNTAGGED = "untagged"
+
+def configure_connection(connection, journal_mode=JOURNAL_MODE, synchronous=SYNCHRONOUS):
+    # must come before journal_mode, which writes the header of a new database file
+    connection.execute(f"PRAGMA auto_vacuum = {AUTO_VACUUM}")
+    connection.execute(f"PRAGMA journal_mode = {journal_mode}")
+    connection.execute(f"PRAGMA synchronous = {synchronous}")
+
+def open_connection(path=None, read_only=False, journal_mode=JOURNAL_MODE, synchronous=SYNCHRONOUS):
+    # pooled connections are handed from thread to thread, but only ever used by one at a time
+    connection = sqlite3.connect(path or DATABASE_PATH, timeout=BUSY_TIMEOUT, check_same_thread=False,
+                                 cached_statements=STATEMENT_CACHE_SIZE)
+    configure_connection(connection, journal_mode, synchronous)
+    if read_only:
+        connection.execute("PRAGMA query_only = ON")
+    return connection
+
+class ConnectionPool:
+    # one writer, serialized by a lock (SQLite allows a single writer anyway), and up to
+    # `size` read-only connections that run in parallel with it under WAL
+    def __init__(self, path=None, size=READ_POOL_SIZE, journal_mode=JOURNAL_MODE, synchronous=SYNCHRONOUS):
+        self.path = path or DATABASE_PATH
+        self.size = size
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.write_connection = open_connection(self.path, journal_mode=journal_mode, synchronous=synchronous)
+        for initializer in _initializers:
+            initializer(self.write_connection)
+        self.write_lock = threading.RLock()
+        self.idle_readers = queue.LifoQueue()
+        self.created_readers = 0
+        self.readers_lock = threading.Lock()
+
+    def acquire_reader(self):
+        try:
+            return self.idle_readers.get_nowait()
+        except queue.Empty:
+            pass
+        with self.readers_lock:
+            if self.created_readers < self.size:
+                self.created_readers += 1
+                return open_connection(self.path, read_only=True, journal_mode=self.journal_mode,
+                                       synchronous=self.synchronous)
+        return self.idle_readers.get()
+
+    def release_reader(self, connection):
+        if connection.in_transaction:
+            connection.rollback()
+        self.idle_readers.put(connection)
+
+    @contextmanager
+    def reader(self):
+        connection = self.acquire_reader()
+        try:
+            yield connection
+        finally:
+            self.release_reader(connection)
+
+    @contextmanager
+    def writer(self):
+        with self.write_lock:
+            yield self.write_connection
+
+    def close(self):
+        with self.write_lock:
+            self.write_connection.close()
+        with self.readers_lock:
+            while self.created_readers:
+                self.idle_readers.get().close()
+                self.created_readers -= 1
+
+_pool = None
+_pool_lock = threading.Lock()
+_local = threading.local()
+_initializers = []
+
+def on_open(initializer):
+    # initializer(connection) runs on the write connection of every new pool, e.g. to migrate the schema
+    _initializers.append(initializer)
+
+def configure(path=None, size=READ_POOL_SIZE, journal_mode=JOURNAL_MODE, synchronous=SYNCHRONOUS):
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+        _pool = ConnectionPool(path, size, journal_mode, synchronous)
+    return _pool
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool()
+    return _pool
+
+def data_version(blocking=True):
+    # PRAGMA data_version on the writer only moves when another process commits to the file: this pool writes
+    # through that connection and its readers never write. None when blocking=False and the writer is in use
+    pool = get_pool()
+    if not pool.write_lock.acquire(blocking):
+        return None
+    try:
+        return pool.write_connection.execute("PRAGMA data_version").fetchone()[0]
+    finally:
+        pool.write_lock.release()
+
+def _transaction_depth():
+    return getattr(_local, "transaction_depth", 0)
+
+def in_transaction():
+    return _transaction_depth() > 0
+
+def after_commit(callback):
+    # runs callback once the enclosing transaction has committed, or right away outside one; the callbacks
+    # of a transaction that rolls back are dropped
+    if _transaction_depth() == 0:
+        callback()
+        return
+    _local.__dict__.setdefault("commit_callbacks", []).append(callback)
+
+# connection each thread is currently running statements on, so interrupt() can reach it
+_active_connections = {}
+
+def interrupt(thread_id):
+    connection = _active_connections.get(thread_id)
+    if connection is not None:
+        connection.interrupt()
+
+@contextmanager
+def tagged(tag):
+    # names the call site of the statements run inside it, e.g. "search" or "login"; nested tags
+    # join into a path such as "import/insert". Also usable as a function decorator
+    tags = _local.__dict__.setdefault("tags", [])
+    if not tags:
+        tags.append(tag)
+    elif tags[-1].rpartition("/")[2] == tag:
+        tags.append(tags[-1])
+    else:
+        tags.append(f"{tags[-1]}/{tag}")
+    try:
+        yield
+    finally:
+        tags.pop()
+
+def current_tag():
+    tags = getattr(_local, "tags", None)
+    return tags[-1] if tags else UNTAGGED
+
+SHAPE_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+SHAPE_LISTS = re.compile(r"\((?:\s*\?\s*,)+\s*\?\s*\)")
+
+@functools.lru_cache(maxsize=1024)
+def query_shape(query):
+    # statements that differ only in literals, whitespace or the length of an IN list share a shape
+    shape = SHAPE_LITERALS.sub("?", " ".join(query.split()))
+    return SHAPE_LISTS.sub("(?, ...)", shape)
+
+class QueryStats:
+    # per (tag, query shape) counts, rows, time and a latency histogram, plus the most recent slow queries
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.shapes = {}
+            self.slow_queries = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+            self.since = time.time()
+
+    def record(self, tag, shape, elapsed_ms, rows):
+        with self.lock:
+            entry = self.shapes.get((tag, shape))
+            if entry is None:
+                entry = self.shapes[tag, shape] = {"count": 0, "rows": 0, "total_ms": 0.0, "max_ms": 0.0,
+                                                   "buckets": [0] * (len(LATENCY_BUCKETS_MS) + 1)}
+            entry["count"] += 1
+            entry["rows"] += rows
+            entry["total_ms"] += elapsed_ms
+            entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+            entry["buckets"][bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+
+    def record_slow(self, slow_query):
+        with self.lock:
+            self.slow_queries.append(slow_query)
+
+    def snapshot(self):
+        with self.lock:
+            shapes = [(tag, shape, dict(entry, buckets=list(entry["buckets"])))
+                      for (tag, shape), entry in self.shapes.items()]
+            slow_queries = list(self.slow_queries)
+            since = self.since
+        queries = []
+        for tag, shape, entry in sorted(shapes, key=lambda item: -item[2]["total_ms"]):
+            queries.append({
+                "tag": tag,
+                "query": shape,
+                "count": entry["count"],
+                "rows": entry["rows"],
+                "total_ms": round(entry["total_ms"], 3),
+                "mean_ms": round(entry["total_ms"] / entry["count"], 3),
+                "max_ms": round(entry["max_ms"], 3),
+                "p50_ms": histogram_percentile(entry, 0.5),
+                "p95_ms": histogram_percentile(entry, 0.95),
+                "p99_ms": histogram_percentile(entry, 0.99),
+                "histogram": {str(bound): count for bound, count in zip(LATENCY_BUCKETS_MS + ("+Inf",), entry["buckets"])},
+            })
+        return {"since": datetime.datetime.fromtimestamp(since).isoformat(timespec="seconds"),
+                "slow_query_ms": _slow_query_ms, "queries": queries, "slow_queries": slow_queries}
+
+def histogram_percentile(entry, fraction):
+    # upper bound of the bucket holding that percentile; the slowest bucket reports the maximum seen
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS_MS, entry["buckets"]):
+        seen += count
+        if seen >= fraction * entry["count"]:
+            return bound
+    return round(entry["max_ms"], 3)
+
+_stats = QueryStats()
+_metrics_enabled = True
+_slow_query_ms = SLOW_QUERY_MS
+_slow_query_log = None
+_slow_query_log_lock = threading.Lock()
+
+def configure_metrics(enabled=True, slow_query_ms=SLOW_QUERY_MS, slow_query_log=None):
+    # slow_query_log is a file that slow queries are appended to as JSON lines, besides the snapshot
+    global _metrics_enabled, _slow_query_ms, _slow_query_log
+    _metrics_enabled = enabled
+    _slow_query_ms = slow_query_ms
+    _slow_query_log = slow_query_log
+
+def metrics_snapshot():
+    return _stats.snapshot()
+
+def reset_metrics():
+    _stats.reset()
+
+def export_metrics(path):
+    with open(path, "w", encoding="utf-8") as handle:
+        json.dump(metrics_snapshot(), handle, indent=2)
+
+def explain(connection, query, params):
+    try:
+        return [row[3] for row in connection.execute("EXPLAIN QUERY PLAN " + query, params)]
+    except sqlite3.Error:
+        return None
+
+def observe(connection, query, params, elapsed, rows):
+    if not _metrics_enabled:
+        return
+    elapsed_ms = elapsed * 1000
+    tag = current_tag()
+    shape = query_shape(query)
+    _stats.record(tag, shape, elapsed_ms, rows)
+    if elapsed_ms < _slow_query_ms:
+        return
+    # parameters are left out on purpose: they include usernames and password hashes
+    slow_query = {"time": datetime.datetime.now().isoformat(timespec="milliseconds"), "tag": tag,
+                  "ms": round(elapsed_ms, 3), "rows": rows, "query": shape, "plan": explain(connection, query, params)}
+    _stats.record_slow(slow_query)
+    if _slow_query_log:
+        with _slow_query_log_lock, open(_slow_query_log, "a", encoding="utf-8") as handle:
+            handle.write(json.dumps(slow_query) + "\n")
+
+@contextmanager
+def reading():
+    # inside a transaction, reads go to the writer so they see the transaction's own changes
+    if _transaction_depth():
+        yield get_pool().write_connection
+        return
+    with get_pool().reader() as connection:
+        thread_id = threading.get_ident()
+        _active_connections[thread_id] = connection
+        try:
+            yield connection
+        finally:
+            _active_connections.pop(thread_id, None)
+
+@contextmanager
+def writing():
+    with get_pool().writer() as connection:
+        thread_id = threading.get_ident()
+        previous = _active_connections.get(thread_id)
+        _active_connections[thread_id] = connection
+        try:
+            yield connection
+        finally:
+            if previous is None:
+                _active_connections.pop(thread_id, None)
+            else:
+                _active_connections[thread_id] = previous
+
+@contextmanager
+def transaction():
+    with writing() as connection:
+        if _transaction_depth() == 0:
+            connection.execute("BEGIN")
+        _local.transaction_depth = _transaction_depth() + 1
+        try:
+            yield connection
+        except BaseException:
+            _local.transaction_depth -= 1
+            if _local.transaction_depth == 0:
+                connection.rollback()
+                _local.commit_callbacks = []
+            raise
+        _local.transaction_depth -= 1
+        if _local.transaction_depth == 0:
+            connection.commit()
+            callbacks, _local.commit_callbacks = getattr(_local, "commit_callbacks", []), []
+            for callback in callbacks:
+                callback()
+
+# every statement below is timed and counted under the caller's tag; each returns what it always did,
+# and the writes also return the number of rows they changed
+
+def execute_query(query, params=()):
+    with writing() as connection:
+        started = time.perf_counter()
+        changed = connection.execute(query, params).rowcount
+        if _transaction_depth() == 0:
+            connection.commit()
+        observe(connection, query, params, time.perf_counter() - started, max(changed, 0))
+        return changed
+
+def execute_many(query, rows):
+    with writing() as connection:
+        started = time.perf_counter()
+        changed = connection.executemany(query, rows).rowcount
+        if _transaction_depth() == 0:
+            connection.commit()
+        # the first row's parameters stand in for all of them if the plan gets logged
+        first = rows[0] if isinstance(rows, (list, tuple)) and rows else ()
+        observe(connection, query, first, time.perf_counter() - started, max(changed, 0))
+        return changed
+
+def fetch_all(query, params=()):
+    with reading() as connection:
+        started = time.perf_counter()
+        rows = connection.execute(query, params).fetchall()
+        observe(connection, query, params, time.perf_counter() - started, len(rows))
+        return rows
+
+def fetch_one(query, params=()):
+    with reading() as connection:
+        started = time.perf_counter()
+        row = connection.execute(query, params).fetchone()
+        observe(connection, query, params, time.perf_counter() - started, 0 if row is None else 1)
+        return row
+
+def iter_chunks(query, params=(), chunk_size=1000):
+    # holds one reader for as long as the caller keeps consuming chunks; only the time spent in
+    # SQLite counts towards the statement, not the time the caller takes between chunks
+    with reading() as connection:
+        elapsed, fetched = 0.0, 0
+        started = time.perf_counter()
+        export_cursor = connection.execute(query, params)
+        try:
+            columns = [column[0] for column in export_cursor.description]
+            while True:
+                rows = export_cursor.fetchmany(chunk_size)
+                elapsed += time.perf_counter() - started
+                if not rows:
+                    break
+                fetched += len(rows)
+                yield columns, rows
+                started = time.perf_counter()
+        finally:
+            export_cursor.close()
+            observe(connection, query, params, elapsed, fetched)
+
+def compact_step(connection, step_pages):
+    free_pages = connection.execute("PRAGMA freelist_count").fetchone()[0]
+    # executescript, because execute() steps a statement that returns no rows only once
+    connection.executescript(f"PRAGMA incremental_vacuum({step_pages});")
+    return free_pages - connection.execute("PRAGMA freelist_count").fetchone()[0]
+
+def compact(step_pages):
+    # hands free pages back to the file system a step at a time, so the write lock is only held briefly;
+    # returns the pages freed, always 0 unless auto_vacuum is INCREMENTAL
+    with writing() as connection:
+        if connection.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return 0
+    freed = 0
+    while True:
+        with writing() as connection:
+            step = compact_step(connection, step_pages)
+        if not step:
+            break
+        freed += step
+    with writing() as connection:
+        connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return freed
+
+def vacuum():
+    # rewrites the whole file under the write lock; also switches older databases to AUTO_VACUUM
+    with writing() as connection:
+        connection.execute(f"PRAGMA auto_vacuum = {AUTO_VACUUM}")
+        connection.execute("VACUUM")
+        connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+def get_schema_version(connection):
+    return connection.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(migrations, connection=None):
+    if connection is None:
+        with writing() as connection:
+            return migrate(migrations, connection)
+    version = get_schema_version(connection)
+    for number, migration in enumerate(migrations[version:], start=version + 1):
+        connection.execute("BEGIN")
+        try:
+            migration(connection)
+            connection.execute(f"PRAGMA user_version = {number}")
+        except Exception:
+            connection.rollback()
+            raise
+        connection.commit()
+    return get_schema_version(connection)
@@ -0,0 +1,2132 @@
+import re
+import os
+import csv
+import json
+import array
+import hmac
+import time
+import base64
+import decimal
+import hashlib
+import logging
+import operator
+import itertools
+import secrets
+import datetime
+import functools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+from database import execute_many, execute_query, fetch_all, fetch_one, transaction
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+def create_tables(connection):
+    connection.execute('''CREATE TABLE IF NOT EXISTS users (
+        username TEXT PRIMARY KEY,
+        first_name TEXT,
+        last_name TEXT,
+        phone TEXT,
+        password TEXT,
+        city TEXT,
+        email TEXT,
+        birthdate TEXT,
+        security_question TEXT,
+        security_answer TEXT
+    )''')
+
+    connection.execute('''CREATE TABLE IF NOT EXISTS incomes (
+        username TEXT,
+        amount REAL,
+        date TEXT,
+        source TEXT,
+        description TEXT,
+        type TEXT
+    )''')
+
+    connection.execute('''CREATE TABLE IF NOT EXISTS expenses (
+        username TEXT,
+        amount REAL,
+        date TEXT,
+        category TEXT,
+        description TEXT,
+        type TEXT
+    )''')
+
+    connection.execute('''CREATE TABLE IF NOT EXISTS categories (
+        username TEXT,
+        category TEXT
+    )''')
+
+RECORD_LABELS = {"incomes": "source", "expenses": "category"}
+RECORD_COLUMNS = {table: ("username", "amount", "date", label, "description", "type", "currency")
+                  for table, label in RECORD_LABELS.items()}
+
+# amounts are stored as integer cents next to an ISO 4217 currency code
+DEFAULT_CURRENCY = "IRR"
+MAX_CENTS = 2 ** 63 - 1
+CENT = decimal.Decimal("0.01")
+AMOUNT_TEXT = "printf('%d.%02d', amount / 100, amount % 100)"
+
+# dates are stored as ISO "YYYY-MM-DD" text, which sorts and range-compares like the dates themselves
+DATE_CACHE_SIZE = 16384
+DATE_PATTERN = re.compile(r"(\d{4})-(\d{1,2})-(\d{1,2})")
+
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+def iso_date(date_text):
+    # accepts what strptime("%Y-%m-%d") did, e.g. "2024-1-5", at a fraction of its cost; records repeat
+    # the same few thousand dates, so most calls are cache hits. None when the text is not a date
+    match = DATE_PATTERN.fullmatch(date_text) if isinstance(date_text, str) else None
+    if match is None:
+        return None
+    try:
+        return datetime.date(int(match[1]), int(match[2]), int(match[3])).isoformat()
+    except ValueError:
+        return None
+
+def parse_date(date_text):
+    date = iso_date(date_text)
+    return None if date is None else datetime.date.fromisoformat(date)
+
+def normalize_date(date_text):
+    return iso_date(date_text) or date_text
+
+def create_record_indexes(connection):
+    for table in ("incomes", "expenses"):
+        connection.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_username_date ON {table} (username, date)")
+        connection.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_username_amount ON {table} (username, amount)")
+    connection.execute("CREATE INDEX IF NOT EXISTS idx_categories_username ON categories (username)")
+
+def normalize_record_dates(connection):
+    # strptime accepts "2024-1-5", which does not sort or range-compare correctly as text
+    connection.create_function("normalize_date", 1, normalize_date)
+    for table in ("incomes", "expenses"):
+        connection.execute(f"UPDATE {table} SET date = normalize_date(date) "
+                           "WHERE date NOT GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'")
+
+def create_import_checkpoints(connection):
+    connection.execute('''CREATE TABLE IF NOT EXISTS import_checkpoints (
+        path TEXT,
+        username TEXT,
+        record_table TEXT,
+        offset INTEGER,
+        line INTEGER,
+        imported INTEGER,
+        rejected INTEGER,
+        PRIMARY KEY (path, username, record_table)
+    )''')
+
+# labels are not indexed: they live in the categories table, so a rename never touches the index
+FTS_COLUMNS = {table: ("username", "description", "type") for table in RECORD_LABELS}
+
+def create_full_text_index(connection):
+    for table, fts_columns in FTS_COLUMNS.items():
+        column_list = ", ".join(fts_columns)
+        new_values = ", ".join(f"new.{column}" for column in fts_columns)
+        connection.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5("
+                           f"{column_list}, content='{table}', content_rowid='rowid', prefix='2 3')")
+        connection.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO {table}_fts (rowid, {column_list}) VALUES (new.rowid, {new_values});
+        END''')
+        create_full_text_triggers(connection, table)
+        connection.execute(f"INSERT INTO {table}_fts ({table}_fts) VALUES ('rebuild')")
+
+def create_full_text_triggers(connection, table):
+    fts_columns = FTS_COLUMNS[table]
+    column_list = ", ".join(fts_columns)
+    new_values = ", ".join(f"new.{column}" for column in fts_columns)
+    old_values = ", ".join(f"old.{column}" for column in fts_columns)
+    connection.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table} BEGIN
+        INSERT INTO {table}_fts ({table}_fts, rowid, {column_list}) VALUES ('delete', old.rowid, {old_values});
+    END''')
+    connection.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_fts_update AFTER UPDATE ON {table} BEGIN
+        INSERT INTO {table}_fts ({table}_fts, rowid, {column_list}) VALUES ('delete', old.rowid, {old_values});
+        INSERT INTO {table}_fts (rowid, {column_list}) VALUES (new.rowid, {new_values});
+    END''')
+
+def rebuild_rollups(connection):
+    # rollups are keyed by category id, 0 standing for records without one
+    connection.execute("DELETE FROM record_totals_daily")
+    connection.execute("DELETE FROM record_totals_monthly")
+    for table, label in RECORD_LABELS.items():
+        connection.execute(f'''INSERT INTO record_totals_daily (username, record_table, currency, day, label_id, total, count)
+                               SELECT username, '{table}', currency, date, COALESCE({label}_id, 0), SUM(amount), COUNT(*)
+                               FROM {table} GROUP BY username, currency, date, COALESCE({label}_id, 0)''')
+    connection.execute('''INSERT INTO record_totals_monthly (username, record_table, currency, month, label_id, total, count)
+                          SELECT username, record_table, currency, substr(day, 1, 7), label_id, SUM(total), SUM(count)
+                          FROM record_totals_daily GROUP BY username, record_table, currency, substr(day, 1, 7), label_id''')
+
+def create_rollup_tables(connection):
+    connection.execute('''CREATE TABLE IF NOT EXISTS record_totals_daily (
+        username TEXT,
+        record_table TEXT,
+        day TEXT,
+        label TEXT,
+        total REAL,
+        count INTEGER,
+        PRIMARY KEY (username, record_table, day, label)
+    ) WITHOUT ROWID''')
+    connection.execute('''CREATE TABLE IF NOT EXISTS record_totals_monthly (
+        username TEXT,
+        record_table TEXT,
+        month TEXT,
+        label TEXT,
+        total REAL,
+        count INTEGER,
+        PRIMARY KEY (username, record_table, month, label)
+    ) WITHOUT ROWID''')
+    # populated by store_amounts_in_cents, which replaces these tables with their per-currency form
+
+def drop_full_text_insert_triggers(connection):
+    # FTS5 flushes its pending terms at every trigger savepoint, which made bulk inserts ~5x slower;
+    # save_incomes/save_expenses index their rows in one statement per batch instead
+    for table in FTS_COLUMNS:
+        connection.execute(f"DROP TRIGGER IF EXISTS {table}_fts_insert")
+
+def verify_cent_conversion(connection, table):
+    # every row must land on its nearest cent, and every user's total must be the exact sum of the
+    # old values; only rows that carried fractions of a cent may move a total, by under half a cent each
+    half_cent = decimal.Decimal("0.5")
+    fraction = decimal.Decimal("0.000001")
+    totals = {}
+    for username, amount, cents in connection.execute(f'''SELECT old.username, old.amount, new.amount
+                                                          FROM {table} AS old JOIN {table}_cents AS new
+                                                          ON new.rowid = old.rowid'''):
+        exact = decimal.Decimal(amount or 0) * 100
+        if abs(exact - (cents or 0)) > half_cent:
+            raise RuntimeError(f"{table}: {amount!r} converted to {cents} cents")
+        old_total, new_total, rounded = totals.get(username, (0, 0, 0))
+        totals[username] = (old_total + exact, new_total + (cents or 0),
+                            rounded + (abs(exact - (cents or 0)) > fraction))
+    for username, (old_total, new_total, rounded) in totals.items():
+        if not rounded and old_total.to_integral_value(decimal.ROUND_HALF_EVEN) != new_total:
+            raise RuntimeError(f"{table}: total for {username!r} changed from {old_total / 100} to {new_total / 100}")
+    old_count = connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    new_count = connection.execute(f"SELECT COUNT(*) FROM {table}_cents").fetchone()[0]
+    if old_count != new_count:
+        raise RuntimeError(f"{table}: {old_count} rows became {new_count}")
+
+def create_quarantined_records(connection):
+    # records moved aside by a migration because a value in them cannot be converted, kept as they were
+    connection.execute('''CREATE TABLE IF NOT EXISTS quarantined_records (
+        source_table TEXT,
+        source_rowid INTEGER,
+        username TEXT,
+        amount,
+        date TEXT,
+        label TEXT,
+        description TEXT,
+        type TEXT,
+        reason TEXT
+    )''')
+
+def quarantine_unconvertible_amounts(connection, table, label):
+    # the old validation (float(amount) > 0) let through inf, 1e400 and the like, which no cent value can hold;
+    # they are moved to quarantined_records rather than failing the migration on every open
+    condition = f"amount IS NOT NULL AND (typeof(amount) NOT IN ('integer', 'real') OR abs(amount) * 100 > {MAX_CENTS})"
+    rowids = [row[0] for row in connection.execute(f"SELECT rowid FROM {table} WHERE {condition} ORDER BY rowid")]
+    if not rowids:
+        return
+    connection.execute(f'''INSERT INTO quarantined_records (source_table, source_rowid, username, amount, date, label,
+                                                              description, type, reason)
+                           SELECT '{table}', rowid, username, amount, date, {label}, description, type,
+                                  CASE WHEN typeof(amount) IN ('integer', 'real') THEN 'amount out of range'
+                                       ELSE 'amount is not a number' END
+                           FROM {table} WHERE {condition}''')
+    connection.execute(f"DELETE FROM {table} WHERE {condition}")
+    logger.warning("%s: moved %d records whose amount cannot be stored in cents to quarantined_records (rowids %s); "
+                   "correct them and add them again as new records", table, len(rowids), ", ".join(map(str, rowids)))
+
+def store_amounts_in_cents(connection):
+    # SQLite cannot change a column's type in place, so each table is copied (keeping rowids, which the
+    # full-text index refers to), checked against the original and swapped in
+    create_quarantined_records(connection)
+    for table, label in RECORD_LABELS.items():
+        quarantine_unconvertible_amounts(connection, table, label)
+        connection.execute(f'''CREATE TABLE {table}_cents (
+            username TEXT,
+            amount INTEGER,
+            date TEXT,
+            {label} TEXT,
+            description TEXT,
+            type TEXT,
+            currency TEXT NOT NULL DEFAULT '{DEFAULT_CURRENCY}'
+        )''')
+        connection.execute(f'''INSERT INTO {table}_cents (rowid, username, amount, date, {label}, description, type)
+                               SELECT rowid, username, CAST(ROUND(amount * 100) AS INTEGER), date, {label}, description, type
+                               FROM {table}''')
+        verify_cent_conversion(connection, table)
+        connection.execute(f"DROP TABLE {table}")
+        connection.execute(f"ALTER TABLE {table}_cents RENAME TO {table}")
+        create_full_text_triggers(connection, table)
+    create_record_indexes(connection)
+
+    # populated by normalize_categories, which keys these tables by category id
+    connection.execute("DROP TABLE record_totals_daily")
+    connection.execute("DROP TABLE record_totals_monthly")
+    connection.execute('''CREATE TABLE record_totals_daily (
+        username TEXT,
+        record_table TEXT,
+        currency TEXT,
+        day TEXT,
+        label TEXT,
+        total INTEGER,
+        count INTEGER,
+        PRIMARY KEY (username, record_table, currency, day, label)
+    ) WITHOUT ROWID''')
+    connection.execute('''CREATE TABLE record_totals_monthly (
+        username TEXT,
+        record_table TEXT,
+        currency TEXT,
+        month TEXT,
+        label TEXT,
+        total INTEGER,
+        count INTEGER,
+        PRIMARY KEY (username, record_table, currency, month, label)
+    ) WITHOUT ROWID''')
+
+def hash_stored_secrets(connection):
+    # passwords and security answers were stored as plain text; scrypt releases the GIL, so hash on all cores
+    users = connection.execute("SELECT username, password, security_answer FROM users").fetchall()
+
+    def hash_user(user):
+        username, password, answer = user
+        return (None if password is None or is_secret_hash(password) else hash_secret(password),
+                None if answer is None or is_secret_hash(answer) else hash_secret(answer),
+                username)
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        hashed = list(executor.map(hash_user, users))
+    connection.executemany('''UPDATE users SET password = COALESCE(?, password),
+                              security_answer = COALESCE(?, security_answer) WHERE username = ?''', hashed)
+
+RECORD_VIEWS = {"incomes": "income_rows", "expenses": "expense_rows"}
+
+def create_record_views(connection):
+    # the records as they read before categories got ids, followed by the record id and the category id
+    for table, label in RECORD_LABELS.items():
+        connection.execute(f'''CREATE VIEW IF NOT EXISTS {RECORD_VIEWS[table]} AS
+                               SELECT r.username, r.amount, r.date, c.name AS {label}, r.description, r.type,
+                                      r.currency, r.rowid AS id, r.{label}_id
+                               FROM {table} AS r LEFT JOIN categories AS c ON c.id = r.{label}_id''')
+
+def verify_category_ids(connection, table, label):
+    old_count = connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    new_count = connection.execute(f"SELECT COUNT(*) FROM {table}_by_category").fetchone()[0]
+    if old_count != new_count:
+        raise RuntimeError(f"{table}: {old_count} rows became {new_count}")
+    changed = connection.execute(f'''SELECT COUNT(*) FROM {table} AS old
+                                    JOIN {table}_by_category AS new ON new.rowid = old.rowid
+                                    LEFT JOIN categories AS c ON c.id = new.{label}_id
+                                    WHERE old.username IS NOT NULL
+                                    AND COALESCE(old.{label}, '') != COALESCE(c.name, '')''').fetchone()[0]
+    if changed:
+        raise RuntimeError(f"{table}: {changed} rows lost their {label}")
+
+def normalize_categories(connection):
+    # categories were unkeyed (username, category) pairs and every record repeated its label as text;
+    # labels become rows of an id-keyed categories table that records point to, so a rename is one UPDATE
+    connection.execute('''CREATE TABLE categories_by_id (
+        id INTEGER PRIMARY KEY,
+        username TEXT NOT NULL,
+        name TEXT NOT NULL,
+        UNIQUE (username, name)
+    )''')
+    connection.execute('''INSERT OR IGNORE INTO categories_by_id (username, name)
+                          SELECT username, category FROM categories
+                          WHERE username IS NOT NULL AND category != '' ORDER BY rowid''')
+    for table, label in RECORD_LABELS.items():
+        connection.execute(f'''INSERT OR IGNORE INTO categories_by_id (username, name)
+                               SELECT DISTINCT username, {label} FROM {table}
+                               WHERE {label} != '' AND username IS NOT NULL''')
+    connection.execute("DROP TABLE categories")
+    connection.execute("ALTER TABLE categories_by_id RENAME TO categories")
+
+    # copied like store_amounts_in_cents does, keeping rowids; the full-text index is rebuilt without labels
+    for table, label in RECORD_LABELS.items():
+        connection.execute(f'''CREATE TABLE {table}_by_category (
+            username TEXT,
+            amount INTEGER,
+            date TEXT,
+            {label}_id INTEGER REFERENCES categories (id),
+            description TEXT,
+            type TEXT,
+            currency TEXT NOT NULL DEFAULT '{DEFAULT_CURRENCY}'
+        )''')
+        connection.execute(f'''INSERT INTO {table}_by_category (rowid, username, amount, date, {label}_id, description,
+                                                                type, currency)
+                               SELECT r.rowid, r.username, r.amount, r.date, c.id, r.description, r.type, r.currency
+                               FROM {table} AS r LEFT JOIN categories AS c ON c.username = r.username AND c.name = r.{label}''')
+        verify_category_ids(connection, table, label)
+        connection.execute(f"DROP TABLE {table}")
+        connection.execute(f"ALTER TABLE {table}_by_category RENAME TO {table}")
+        connection.execute(f"CREATE INDEX idx_{table}_username_date ON {table} (username, date)")
+        connection.execute(f"CREATE INDEX idx_{table}_username_amount ON {table} (username, amount)")
+
+        column_list = ", ".join(FTS_COLUMNS[table])
+        connection.execute(f"DROP TABLE {table}_fts")
+        connection.execute(f"CREATE VIRTUAL TABLE {table}_fts USING fts5("
+                           f"{column_list}, content='{table}', content_rowid='rowid', prefix='2 3')")
+        connection.execute(f"INSERT INTO {table}_fts ({table}_fts) VALUES ('rebuild')")
+        create_full_text_triggers(connection, table)
+    create_record_views(connection)
+
+    connection.execute("DROP TABLE record_totals_daily")
+    connection.execute("DROP TABLE record_totals_monthly")
+    connection.execute('''CREATE TABLE record_totals_daily (
+        username TEXT,
+        record_table TEXT,
+        currency TEXT,
+        day TEXT,
+        label_id INTEGER,
+        total INTEGER,
+        count INTEGER,
+        PRIMARY KEY (username, record_table, currency, day, label_id)
+    ) WITHOUT ROWID''')
+    connection.execute('''CREATE TABLE record_totals_monthly (
+        username TEXT,
+        record_table TEXT,
+        currency TEXT,
+        month TEXT,
+        label_id INTEGER,
+        total INTEGER,
+        count INTEGER,
+        PRIMARY KEY (username, record_table, currency, month, label_id)
+    ) WITHOUT ROWID''')
+    rebuild_rollups(connection)
+
+def create_balance_checkpoints(connection):
+    connection.execute('''CREATE TABLE IF NOT EXISTS balance_checkpoints (
+        username TEXT,
+        currency TEXT,
+        month TEXT,
+        net INTEGER,
+        cumulative INTEGER,
+        PRIMARY KEY (username, currency, month)
+    ) WITHOUT ROWID''')
+    rebuild_balance_checkpoints(connection)
+
+def rebuild_balance_checkpoints(connection):
+    # one row per user, currency and month with records: that month's incomes minus expenses and the running
+    # total of every month up to it, in cents
+    connection.execute("DELETE FROM balance_checkpoints")
+    connection.execute('''INSERT INTO balance_checkpoints (username, currency, month, net, cumulative)
+                          SELECT username, currency, month, net,
+                                 SUM(net) OVER (PARTITION BY username, currency ORDER BY month)
+                          FROM (SELECT username, currency, month,
+                                       SUM(CASE record_table WHEN 'incomes' THEN total ELSE -total END) AS net
+                                FROM record_totals_monthly GROUP BY username, currency, month)''')
+
+def create_recurring_rules(connection):
+    connection.execute('''CREATE TABLE IF NOT EXISTS recurring_rules (
+        id INTEGER PRIMARY KEY,
+        username TEXT,
+        record_table TEXT,
+        amount INTEGER,
+        label_id INTEGER,
+        description TEXT,
+        type TEXT,
+        currency TEXT,
+        frequency TEXT,
+        start_date TEXT,
+        end_date TEXT
+    )''')
+    connection.execute("CREATE INDEX IF NOT EXISTS idx_recurring_rules_username ON recurring_rules (username)")
+
+def create_category_budgets(connection):
+    # a monthly spending limit per category, in cents; what has been spent comes from record_totals_monthly
+    connection.execute('''CREATE TABLE IF NOT EXISTS category_budgets (
+        username TEXT,
+        category_id INTEGER,
+        currency TEXT,
+        amount INTEGER,
+        PRIMARY KEY (username, category_id, currency)
+    ) WITHOUT ROWID''')
+
+MIGRATIONS = [
+    create_record_indexes,
+    normalize_record_dates,
+    create_import_checkpoints,
+    create_full_text_index,
+    create_rollup_tables,
+    drop_full_text_insert_triggers,
+    store_amounts_in_cents,
+    hash_stored_secrets,
+    normalize_categories,
+    create_balance_checkpoints,
+    create_recurring_rules,
+    create_category_budgets,
+    # databases already past store_amounts_in_cents get the table too
+    create_quarantined_records,
+]
+
+def migrate(connection=None):
+    if connection is None:
+        with database.writing() as connection:
+            return migrate(connection)
+    create_tables(connection)
+    connection.commit()
+    return database.migrate(MIGRATIONS, connection)
+
+# the schema is brought up to date whenever the first connection to a database is opened
+database.on_open(migrate)
+
+USER_CACHE_SIZE = 256
+USER_CACHE_TTL = 300
+
+_user_cache = OrderedDict()
+_user_cache_lock = threading.Lock()
+
+USER_SETTINGS_FIELDS = ("password", "email", "birthdate", "phone", "city")
+
+def get_user(username):
+    return fetch_one("SELECT * FROM users WHERE username=?", (username,))
+
+def user_exists(username):
+    return fetch_one("SELECT 1 FROM users WHERE username=?", (username,)) is not None
+
+def get_cached_user(username):
+    with _user_cache_lock:
+        entry = _user_cache.get(username)
+        if entry is None:
+            return None
+        user, expires_at = entry
+        if expires_at < time.monotonic():
+            del _user_cache[username]
+            return None
+        _user_cache.move_to_end(username)
+        return user
+
+def cache_user(user):
+    with _user_cache_lock:
+        _user_cache[user[0]] = (user, time.monotonic() + USER_CACHE_TTL)
+        _user_cache.move_to_end(user[0])
+        while len(_user_cache) > USER_CACHE_SIZE:
+            _user_cache.popitem(last=False)
+
+def invalidate_user(username):
+    with _user_cache_lock:
+        _user_cache.pop(username, None)
+
+# scrypt cost; raising these makes every stored hash get recomputed at that user's next login
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_BYTES = 16
+HASH_BYTES = 32
+
+def scrypt(secret, salt, n, r, p):
+    # scrypt needs about 128 * n * r * p bytes; leave headroom for OpenSSL's own bookkeeping
+    return hashlib.scrypt(secret.encode("utf-8"), salt=salt, n=n, r=r, p=p, dklen=HASH_BYTES,
+                          maxmem=min(256 * n * r * p, 2 ** 31 - 1))
+
+def hash_secret(secret):
+    salt = os.urandom(SALT_BYTES)
+    digest = scrypt(secret, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return "scrypt${}${}${}${}${}".format(SCRYPT_N, SCRYPT_R, SCRYPT_P, base64.b64encode(salt).decode("ascii"),
+                                          base64.b64encode(digest).decode("ascii"))
+
+def parse_secret_hash(stored):
+    try:
+        scheme, n, r, p, salt, digest = stored.split("$")
+        if scheme != "scrypt":
+            return None
+        return int(n), int(r), int(p), base64.b64decode(salt), base64.b64decode(digest)
+    except (AttributeError, ValueError):
+        return None
+
+def is_secret_hash(stored):
+    return parse_secret_hash(stored) is not None
+
+def verify_secret(secret, stored):
+    parsed = parse_secret_hash(stored)
+    if parsed is None:
+        return False
+    n, r, p, salt, digest = parsed
+    return hmac.compare_digest(scrypt(secret, salt, n, r, p), digest)
+
+def needs_rehash(stored):
+    parsed = parse_secret_hash(stored)
+    return parsed is None or parsed[:3] != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+
+@database.tagged("login")
+def authenticate(username, password):
+    user = get_cached_user(username) or get_user(username)
+    if user is None or not verify_secret(password, user[4]):
+        return None
+    if needs_rehash(user[4]):
+        execute_query("UPDATE users SET password = ? WHERE username = ?", (hash_secret(password), username))
+        invalidate_user(username)
+        user = get_user(username)
+    cache_user(user)
+    return user
+
+SESSION_TTL = 3600
+SESSION_CACHE_SIZE = 10_000
+
+# token -> (username, expires_at), so API clients pay the scrypt cost once per session, not per request
+_sessions = OrderedDict()
+_sessions_lock = threading.Lock()
+
+def create_session(username):
+    token = secrets.token_urlsafe(32)
+    with _sessions_lock:
+        _sessions[token] = (username, time.monotonic() + SESSION_TTL)
+        while len(_sessions) > SESSION_CACHE_SIZE:
+            _sessions.popitem(last=False)
+    return token
+
+def session_user(token):
+    with _sessions_lock:
+        entry = _sessions.get(token)
+        if entry is None:
+            return None
+        username, expires_at = entry
+        if expires_at < time.monotonic():
+            del _sessions[token]
+            return None
+        return username
+
+def end_session(token):
+    with _sessions_lock:
+        _sessions.pop(token, None)
+
+def end_user_sessions(username):
+    with _sessions_lock:
+        for token in [token for token, (owner, _) in _sessions.items() if owner == username]:
+            del _sessions[token]
+
+@database.tagged("settings")
+def update_user_field(username, field, value):
+    if field not in USER_SETTINGS_FIELDS:
+        raise ValueError(f"Unknown user field: {field}")
+    if field == "password":
+        value = hash_secret(value)
+    execute_query(f"UPDATE users SET {field} = ? WHERE username = ?", (value, username))
+    invalidate_user(username)
+    if field == "password":
+        end_user_sessions(username)
+
+DELETE_BATCH_SIZE = 1000
+FTS_MERGE_PAGES = 1000
+# merged after each deletion batch, and only where a level of the index has piled up segments
+FTS_BATCH_MERGE_PAGES = 100
+VACUUM_STEP_PAGES = 4096
+
+# table -> key its rows are deleted by, for every table holding a user's rows; records come before the
+# categories they refer to, and the users row itself is deleted last
+USER_DATA_TABLES = {
+    "incomes": "rowid",
+    "expenses": "rowid",
+    "record_totals_daily": "username, record_table, currency, day, label_id",
+    "record_totals_monthly": "username, record_table, currency, month, label_id",
+    "balance_checkpoints": "username, currency, month",
+    "recurring_rules": "rowid",
+    "category_budgets": "username, category_id, currency",
+    "quarantined_records": "rowid",
+    "categories": "rowid",
+    "import_checkpoints": "rowid",
+}
+
+def count_user_rows(username):
+    return sum(fetch_one(f"SELECT COUNT(*) FROM {table} WHERE username IS ?", (username,))[0]
+               for table in USER_DATA_TABLES)
+
+def iter_user_row_deletes(username, batch_size=DELETE_BATCH_SIZE):
+    # yields the rows deleted per batch; each batch is its own short transaction, so other readers and
+    # writers get the database in between. `username IS ?` also reaches rows without a username
+    for table, key in USER_DATA_TABLES.items():
+        while True:
+            with transaction():
+                deleted = execute_query(f'''DELETE FROM {table} WHERE ({key}) IN (
+                                                SELECT {key} FROM {table} WHERE username IS ? LIMIT ?)''',
+                                        (username, batch_size))
+                database.after_commit(functools.partial(bump_write_generation, [username]))
+                database.after_commit(functools.partial(evict_from_analytics_cache, username))
+            if not deleted:
+                break
+            if table in FTS_COLUMNS:
+                # every batch leaves a segment of deletion markers; merging them as they pile up keeps the index
+                # from fragmenting under searches that run meanwhile. The full merge waits for the end
+                merge_full_text_step(table, FTS_BATCH_MERGE_PAGES, force=False)
+            yield deleted
+
+@database.tagged("delete-user")
+def delete_user(username, batch_size=DELETE_BATCH_SIZE, progress=None):
+    # the users row goes last: until then the name cannot be registered again, and an interrupted
+    # deletion can simply be run again. progress(deleted, total) is called after every batch
+    end_user_sessions(username)
+    invalidate_user(username)
+    total = count_user_rows(username)
+    deleted = 0
+    for count in iter_user_row_deletes(username, batch_size):
+        deleted += count
+        if progress:
+            progress(deleted, total)
+    execute_query("DELETE FROM users WHERE username = ?", (username,))
+    invalidate_user(username)
+    end_user_sessions(username)
+    compact_storage()
+    return deleted
+
+def merge_full_text_step(table, step_pages=FTS_MERGE_PAGES, force=True):
+    # FTS5 only records deletions; merging its segments is what drops the deleted rows' entries. force merges
+    # whatever the segments look like, otherwise only levels with enough of them. Returns whether the step
+    # merged anything: one that found nothing to do changes just the one command row
+    with transaction() as connection:
+        before = connection.total_changes
+        connection.execute(f"INSERT INTO {table}_fts ({table}_fts, rank) VALUES ('merge', ?)",
+                           (-step_pages if force else step_pages,))
+        return connection.total_changes - before > 1
+
+def merge_full_text_index(step_pages=FTS_MERGE_PAGES):
+    for table in FTS_COLUMNS:
+        while merge_full_text_step(table, step_pages):
+            pass
+
+def compact_storage(vacuum=False):
+    merge_full_text_index()
+    if vacuum:
+        database.vacuum()
+    else:
+        database.compact(VACUUM_STEP_PAGES)
+
+def find_orphaned_usernames():
+    orphans = set()
+    for table in USER_DATA_TABLES:
+        orphans.update(row[0] for row in fetch_all(f'''SELECT DISTINCT username FROM {table}
+                                                        WHERE username IS NULL
+                                                        OR username NOT IN (SELECT username FROM users)'''))
+    return sorted(orphans, key=lambda username: username or "")
+
+@database.tagged("sweep")
+def sweep_orphans(batch_size=DELETE_BATCH_SIZE, progress=None, vacuum=False):
+    # one-off cleanup of rows left behind by deletions that only removed the users row;
+    # vacuum=True rewrites the file once, which also turns on incremental compaction for older databases
+    orphans = find_orphaned_usernames()
+    total = sum(count_user_rows(username) for username in orphans)
+    deleted = 0
+    for username in orphans:
+        for count in iter_user_row_deletes(username, batch_size):
+            deleted += count
+            if progress:
+                progress(deleted, total)
+    compact_storage(vacuum)
+    return {"usernames": len(orphans), "deleted": deleted}
+
+@database.tagged("signup")
+def save_user(user_data):
+    user_data = list(user_data)
+    user_data[4] = hash_secret(user_data[4])
+    user_data[9] = hash_secret(user_data[9])
+    execute_query('''INSERT INTO users (username, first_name, last_name, phone, password, city, email, birthdate, security_question, security_answer)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', user_data)
+
+def load_records(username, record_table):
+    columns = ", ".join(RECORD_COLUMNS[record_table])
+    return fetch_all(f"SELECT {columns} FROM {RECORD_VIEWS[record_table]} WHERE username=?", (username,))
+
+def load_incomes(username):
+    return load_records(username, "incomes")
+
+def save_income(income_data, currency=DEFAULT_CURRENCY):
+    save_incomes([income_data], currency)
+
+@database.tagged("insert")
+def save_incomes(incomes, currency=DEFAULT_CURRENCY):
+    incomes = list(incomes)
+    with transaction():
+        ids = category_ids((username, source) for username, _, _, source, _, _ in incomes)
+        rows = [(username, to_cents(amount), normalize_date(date), ids.get((username, source)), description, type_,
+                 currency)
+                for username, amount, date, source, description, type_ in incomes]
+        execute_many('''INSERT INTO incomes (username, amount, date, source_id, description, type, currency)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)''', rows)
+        index_new_records("incomes", len(rows))
+        update_rollups("incomes", rows)
+        database.after_commit(functools.partial(bump_write_generation, {row[0] for row in rows}))
+        append_to_analytics_cache("incomes", rows)
+
+def load_expenses(username):
+    return load_records(username, "expenses")
+
+def save_expense(expense_data, currency=DEFAULT_CURRENCY):
+    return save_expenses([expense_data], currency)
+
+@database.tagged("insert")
+def save_expenses(expenses, currency=DEFAULT_CURRENCY):
+    expenses = list(expenses)
+    with transaction():
+        ids = category_ids((username, category) for username, _, _, category, _, _ in expenses)
+        rows = [(username, to_cents(amount), normalize_date(date), ids.get((username, category)), description, type_,
+                 currency)
+                for username, amount, date, category, description, type_ in expenses]
+        execute_many('''INSERT INTO expenses (username, amount, date, category_id, description, type, currency)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)''', rows)
+        index_new_records("expenses", len(rows))
+        alerts = check_budgets(update_rollups("expenses", rows))
+        database.after_commit(functools.partial(bump_write_generation, {row[0] for row in rows}))
+        append_to_analytics_cache("expenses", rows)
+    return alerts
+
+def index_new_records(record_table, count):
+    # the batch was just inserted under the write lock, so it holds the highest `count` rowids
+    if not count:
+        return
+    column_list = ", ".join(FTS_COLUMNS[record_table])
+    execute_query(f'''INSERT INTO {record_table}_fts (rowid, {column_list})
+                      SELECT rowid, {column_list} FROM {record_table}
+                      WHERE rowid > (SELECT MAX(rowid) FROM {record_table}) - ?''', (count,))
+
+def update_rollups(record_table, rows):
+    # fold the batch per (user, day, category) first, so a bulk insert costs one upsert per distinct key
+    daily = {}
+    for username, cents, date, label_id, _, _, currency in rows:
+        key = (username, currency, date, label_id or 0)
+        total, count = daily.get(key, (0, 0))
+        daily[key] = (total + cents, count + 1)
+    monthly = {}
+    for (username, currency, date, label_id), (total, count) in daily.items():
+        key = (username, currency, date[:7], label_id)
+        month_total, month_count = monthly.get(key, (0, 0))
+        monthly[key] = (month_total + total, month_count + count)
+
+    execute_many('''INSERT INTO record_totals_daily (username, record_table, currency, day, label_id, total, count)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT DO UPDATE SET total = total + excluded.total, count = count + excluded.count''',
+                 [(username, record_table, currency, day, label_id, total, count)
+                  for (username, currency, day, label_id), (total, count) in daily.items()])
+    execute_many('''INSERT INTO record_totals_monthly (username, record_table, currency, month, label_id, total, count)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT DO UPDATE SET total = total + excluded.total, count = count + excluded.count''',
+                 [(username, record_table, currency, month, label_id, total, count)
+                  for (username, currency, month, label_id), (total, count) in monthly.items()])
+    update_balance_checkpoints(record_table, monthly)
+    return monthly
+
+def update_balance_checkpoints(record_table, monthly):
+    # adds the batch to each month's net, then repairs the running totals from the earliest month it touched
+    # onwards, starting from the checkpoint before it: a record dated this month rewrites one row, a back-dated
+    # one the rows of the months since
+    sign = 1 if record_table == "incomes" else -1
+    nets = {}
+    earliest = {}
+    for (username, currency, month, _), (total, _) in monthly.items():
+        nets[username, currency, month] = nets.get((username, currency, month), 0) + sign * total
+        earliest[username, currency] = min(earliest.get((username, currency), month), month)
+    execute_many('''INSERT INTO balance_checkpoints (username, currency, month, net, cumulative) VALUES (?, ?, ?, ?, 0)
+                    ON CONFLICT DO UPDATE SET net = net + excluded.net''',
+                 [(username, currency, month, net) for (username, currency, month), net in nets.items()])
+    execute_many('''UPDATE balance_checkpoints
+                    SET cumulative = running.net + COALESCE((SELECT cumulative FROM balance_checkpoints
+                                                             WHERE username = ?1 AND currency = ?2 AND month < ?3
+                                                             ORDER BY month DESC LIMIT 1), 0)
+                    FROM (SELECT month, SUM(net) OVER (ORDER BY month) AS net FROM balance_checkpoints
+                          WHERE username = ?1 AND currency = ?2 AND month >= ?3) AS running
+                    WHERE username = ?1 AND currency = ?2 AND balance_checkpoints.month = running.month''',
+                 [(username, currency, month) for (username, currency), month in earliest.items()])
+
+def month_bounds(day):
+    next_month = day.replace(day=28) + datetime.timedelta(days=4)
+    return day.replace(day=1), next_month.replace(day=1) - datetime.timedelta(days=1)
+
+def rollup_total(username, record_table, start, end, currency=DEFAULT_CURRENCY):
+    # in cents; whole months come from the monthly rollup, the partial months at either end from the daily one
+    first_full = start if start.day == 1 else month_bounds(start)[1] + datetime.timedelta(days=1)
+    last_full = end if end == month_bounds(end)[1] else end.replace(day=1) - datetime.timedelta(days=1)
+    if first_full > last_full:
+        return fetch_one('''SELECT COALESCE(SUM(total), 0) FROM record_totals_daily
+                            WHERE username=? AND record_table=? AND currency=? AND day BETWEEN ? AND ?''',
+                         (username, record_table, currency, str(start), str(end)))[0]
+    return fetch_one('''SELECT COALESCE(SUM(total), 0) FROM (
+                            SELECT total FROM record_totals_monthly
+                            WHERE username=? AND record_table=? AND currency=? AND month BETWEEN ? AND ?
+                            UNION ALL
+                            SELECT total FROM record_totals_daily
+                            WHERE username=? AND record_table=? AND currency=?
+                            AND (day BETWEEN ? AND ? OR day BETWEEN ? AND ?))''',
+                     (username, record_table, currency, str(first_full)[:7], str(last_full)[:7],
+                      username, record_table, currency, str(start), str(first_full - datetime.timedelta(days=1)),
+                      str(last_full + datetime.timedelta(days=1)), str(end)))[0]
+
+@database.tagged("report")
+def report_total(username, record_table, filter_type, start_date="", end_date="", currency=DEFAULT_CURRENCY):
+    start, end = get_report_range(filter_type, start_date, end_date)
+    return from_cents(rollup_total(username, record_table, start, end, currency)
+                      + recurring_total(username, record_table, start, end, currency))
+
+def balance_cents(username, day, currency=DEFAULT_CURRENCY):
+    # the checkpoint of the last month before day's, one index lookup, plus day's own month up to day from the
+    # daily rollup, at most a month of rows
+    day = str(day)
+    return fetch_one('''SELECT COALESCE((SELECT cumulative FROM balance_checkpoints
+                                         WHERE username = :username AND currency = :currency AND month < :month
+                                         ORDER BY month DESC LIMIT 1), 0)
+                             + COALESCE((SELECT SUM(CASE record_table WHEN 'incomes' THEN total ELSE -total END)
+                                         FROM record_totals_daily
+                                         WHERE username = :username AND record_table IN ('incomes', 'expenses')
+                                         AND currency = :currency AND day BETWEEN :first AND :day), 0)''',
+                     {"username": username, "currency": currency, "month": day[:7], "first": day[:7] + "-01",
+                      "day": day})[0]
+
+@database.tagged("balance")
+def balance_on(username, day, currency=DEFAULT_CURRENCY):
+    rules = load_recurring_rules(username)
+    return from_cents(balance_cents(username, day, currency) + recurring_net(rules, day, currency))
+
+def period_key(period, day):
+    # the Python side of REPORT_PERIODS
+    if period == "week":
+        day -= datetime.timedelta(days=day.weekday())
+    return day.isoformat()[:{"day": 10, "week": 10, "month": 7, "year": 4}[period]]
+
+@database.tagged("balance")
+def balance_series(username, start, end, period="month", currency=DEFAULT_CURRENCY):
+    # {period: balance at the end of that period} for every period from start's to end's, the last one as of
+    # end itself. Months and years read the checkpoints in the range; days and weeks add the daily nets to the
+    # balance the day before start
+    if period not in REPORT_PERIODS:
+        raise ValueError(f"Unknown report period: {period}")
+    rules = load_recurring_rules(username)
+    points = {}
+    if period in ("month", "year"):
+        balance = balance_cents(username, start.replace(day=1) - datetime.timedelta(days=1), currency)
+        checkpoints = dict(fetch_all('''SELECT month, cumulative FROM balance_checkpoints
+                                        WHERE username = ? AND currency = ? AND month BETWEEN ? AND ?''',
+                                     (username, currency, str(start)[:7], str(end)[:7])))
+        month = start.replace(day=1)
+        while month <= end:
+            balance = checkpoints.get(str(month)[:7], balance)
+            month_end = month_bounds(month)[1]
+            points[period_key(period, month)] = balance + recurring_net(rules, month_end, currency)
+            month = month_end + datetime.timedelta(days=1)
+    else:
+        balance = balance_cents(username, start - datetime.timedelta(days=1), currency)
+        nets = dict(fetch_all('''SELECT day, SUM(CASE record_table WHEN 'incomes' THEN total ELSE -total END)
+                                 FROM record_totals_daily
+                                 WHERE username = ? AND record_table IN ('incomes', 'expenses') AND currency = ?
+                                 AND day BETWEEN ? AND ? GROUP BY day''', (username, currency, str(start), str(end))))
+        day = start
+        while day <= end:
+            balance += nets.get(str(day), 0)
+            points[period_key(period, day)] = balance + recurring_net(rules, day, currency)
+            day += datetime.timedelta(days=1)
+    if points:
+        points[period_key(period, end)] = balance_cents(username, end, currency) + recurring_net(rules, end, currency)
+    return {key: from_cents(value) for key, value in points.items()}
+
+# frequency -> days between occurrences; monthly rules fall on their first date's day of the month, or on the
+# month's last day in shorter months
+RECURRENCE_FREQUENCIES = {"daily": 1, "weekly": 7, "monthly": None}
+
+@database.tagged("recurring")
+def save_recurring_rule(record_table, record_data, frequency, end_date="", currency=DEFAULT_CURRENCY):
+    # record_data is a record as save_incomes/save_expenses take it, dated with the first occurrence; the
+    # occurrences are never stored, searches and reports expand them for their own window. Returns the rule id
+    errors = validate_record(record_table, record_data)
+    if frequency not in RECURRENCE_FREQUENCIES:
+        errors.append(("frequency", "Frequency must be daily, weekly or monthly."))
+    if end_date and not is_valid_date(end_date):
+        errors.append(("end_date", "Invalid end date. Use YYYY-MM-DD."))
+    elif end_date and not errors and iso_date(end_date) < iso_date(record_data[2]):
+        errors.append(("end_date", "The end date is before the first occurrence."))
+    if errors:
+        raise ValueError("\n".join(message for _, message in errors))
+    username, amount, date, label, description, type_ = record_data
+    with transaction():
+        label_id = category_ids([(username, label)]).get((username, label))
+        execute_query('''INSERT INTO recurring_rules (username, record_table, amount, label_id, description, type,
+                                                      currency, frequency, start_date, end_date)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                      (username, record_table, to_cents(amount), label_id, description, type_, currency, frequency,
+                       iso_date(date), iso_date(end_date) if end_date else None))
+        rule_id = fetch_one("SELECT last_insert_rowid()")[0]
+        database.after_commit(functools.partial(bump_write_generation, [username]))
+    return rule_id
+
+@database.tagged("recurring")
+def end_recurring_rule(username, rule_id, end_date):
+    # stops a rule after end_date and keeps its earlier occurrences, unlike deleting it
+    if not is_valid_date(end_date):
+        raise ValueError("Invalid end date. Use YYYY-MM-DD.")
+    with transaction():
+        if not execute_query("UPDATE recurring_rules SET end_date = ? WHERE id = ? AND username = ?",
+                             (iso_date(end_date), rule_id, username)):
+            raise ValueError("No such recurring rule.")
+        database.after_commit(functools.partial(bump_write_generation, [username]))
+
+@database.tagged("recurring")
+def delete_recurring_rule(username, rule_id):
+    with transaction():
+        if not execute_query("DELETE FROM recurring_rules WHERE id = ? AND username = ?", (rule_id, username)):
+            raise ValueError("No such recurring rule.")
+        database.after_commit(functools.partial(bump_write_generation, [username]))
+
+# loaded rules per (username, record_table); every search and report reads them, page cache hits included
+RULE_CACHE_SIZE = 1024
+
+_rule_cache = OrderedDict()
+_rule_cache_lock = threading.Lock()
+
+def clear_rule_cache(connection=None):
+    with _rule_cache_lock:
+        _rule_cache.clear()
+
+database.on_open(clear_rule_cache)
+
+def load_recurring_rules(username, record_table=None):
+    # (id, record_table, cents, label id, label, description, type, currency, frequency, first date, end date or None).
+    # Cached under the same generation as the result pages; inside a transaction, which may not commit what it
+    # reads, and while the writer is busy they come straight from SQLite
+    version = None if database.in_transaction() else database.data_version(blocking=False)
+    if version is None:
+        return read_recurring_rules(username, record_table)
+    key = (username, record_table)
+    generation = (version, write_generation(username))
+    with _rule_cache_lock:
+        entry = _rule_cache.get(key)
+        if entry is not None and entry[0] == generation:
+            _rule_cache.move_to_end(key)
+            return entry[1]
+    rules = read_recurring_rules(username, record_table)
+    with _rule_cache_lock:
+        _rule_cache[key] = (generation, rules)
+        _rule_cache.move_to_end(key)
+        while len(_rule_cache) > RULE_CACHE_SIZE:
+            _rule_cache.popitem(last=False)
+    return rules
+
+@database.tagged("recurring")
+def read_recurring_rules(username, record_table=None):
+    query = '''SELECT r.id, r.record_table, r.amount, r.label_id, c.name, r.description, r.type, r.currency,
+                      r.frequency, r.start_date, r.end_date
+               FROM recurring_rules AS r LEFT JOIN categories AS c ON c.id = r.label_id WHERE r.username = ?'''
+    params = [username]
+    if record_table:
+        query += " AND r.record_table = ?"
+        params.append(record_table)
+    return [row[:9] + (datetime.date.fromisoformat(row[9]), row[10] and datetime.date.fromisoformat(row[10]))
+            for row in fetch_all(query + " ORDER BY r.id", params)]
+
+def occurrence_date(frequency, first, index):
+    step = RECURRENCE_FREQUENCIES[frequency]
+    if step:
+        return first + datetime.timedelta(days=index * step)
+    month = first.month - 1 + index
+    day = datetime.date(first.year + month // 12, month % 12 + 1, 1)
+    return day.replace(day=min(first.day, month_bounds(day)[1].day))
+
+def occurrences_through(frequency, first, day):
+    # how many occurrences fall on or before day, worked out rather than counted
+    if day < first:
+        return 0
+    step = RECURRENCE_FREQUENCIES[frequency]
+    if step:
+        return (day - first).days // step + 1
+    index = (day.year - first.year) * 12 + day.month - first.month
+    return index + (occurrence_date(frequency, first, index) <= day)
+
+def occurrence_count(frequency, first, last, start, end):
+    # occurrences between start and end, in constant time however long the rule has run
+    end = min(end, last) if last else end
+    if end < start:
+        return 0
+    return occurrences_through(frequency, first, end) - occurrences_through(frequency, first,
+                                                                            start - datetime.timedelta(days=1))
+
+def occurrence_dates(frequency, first, last, start, end):
+    # jumps straight to the first occurrence on or after start, so expanding a window costs the occurrences
+    # inside it and not the ones since the rule began
+    end = min(end, last) if last else end
+    index = occurrences_through(frequency, first, start - datetime.timedelta(days=1)) if start > first else 0
+    day = occurrence_date(frequency, first, index)
+    while day <= end:
+        yield day
+        index += 1
+        day = occurrence_date(frequency, first, index)
+
+def recurring_total(username, record_table, start, end, currency=DEFAULT_CURRENCY):
+    # in cents, for report_total
+    return sum(cents * occurrence_count(frequency, first, last, start, end)
+               for _, _, cents, _, _, _, _, rule_currency, frequency, first, last
+               in load_recurring_rules(username, record_table) if rule_currency == currency)
+
+def recurring_net(rules, day, currency=DEFAULT_CURRENCY):
+    # in cents, incomes minus expenses of the rules' occurrences up to day, for the balances
+    return sum((cents if record_table == "incomes" else -cents) * occurrence_count(frequency, first, last, first, day)
+               for _, record_table, cents, _, _, _, _, rule_currency, frequency, first, last in rules
+               if rule_currency == currency)
+
+def recurring_dates(username, record_table, start=None, end=None):
+    # [(rule id, [ISO dates])] of the rules with occurrences between start (default: each rule's first) and end
+    # (default: today)
+    end = end or datetime.date.today()
+    rules = []
+    for rule_id, _, _, _, _, _, _, _, frequency, first, last in load_recurring_rules(username, record_table):
+        dates = [day.isoformat() for day in occurrence_dates(frequency, first, last, start or first, end)]
+        if dates:
+            rules.append((rule_id, dates))
+    return rules
+
+def with_occurrences(username, record_table, columns, where, params, dates, occurrence_where, occurrence_params):
+    # a search or report page over the records and the recurring occurrences in its window together. Each side
+    # is filtered on its own, so the records keep their indexes, and fetch_page adds its bounds to the outer
+    # WHERE. The occurrence dates travel as one JSON parameter; their id is minus the rule's, unique per date,
+    # which is all the (date, id) paging needs
+    label = RECORD_LABELS[record_table]
+    query = f'''SELECT {columns} FROM (
+                    SELECT * FROM {RECORD_VIEWS[record_table]} WHERE {where}
+                    UNION ALL
+                    SELECT * FROM (SELECT r.username, r.amount, d.value AS date, c.name AS {label}, r.description,
+                                          r.type, r.currency, -r.id AS id, r.label_id AS {label}_id
+                                   FROM json_each(?) AS rule
+                                   JOIN recurring_rules AS r ON r.id = rule.value ->> 0
+                                   JOIN json_each(rule.value, '$[1]') AS d
+                                   LEFT JOIN categories AS c ON c.id = r.label_id)
+                    WHERE {occurrence_where})
+                WHERE username=?'''
+    return query, params + [json.dumps(dates)] + occurrence_params + [username]
+
+def recurring_report_rows(username, start, end, period, group_by, min_amount="", max_amount="",
+                          currency=DEFAULT_CURRENCY):
+    # the window's occurrences in the row shape of build_grouped_report_query, for grouped_report to add in
+    low = amount_bound(min_amount) if min_amount else None
+    high = amount_bound(max_amount) if max_amount else None
+    totals = {}
+    rules = load_recurring_rules(username)
+    for _, record_table, cents, _, label, _, type_, rule_currency, frequency, first, last in rules:
+        if rule_currency != currency:
+            continue
+        group = {"none": "", "label": label or "", "type": type_ or ""}[group_by]
+        matched = (low is None or cents >= low) and (high is None or cents <= high)
+        for day in occurrence_dates(frequency, first, last, max(start, first), end):
+            key = (period_key(period, day), record_table, group)
+            matched_total, matched_count, total, count = totals.get(key, (0, 0, 0, 0))
+            totals[key] = (matched_total + cents * matched, matched_count + matched, total + cents, count + 1)
+    return [key + value for key, value in totals.items()]
+
+@database.tagged("categories")
+def load_categories(username):
+    return [row[0] for row in fetch_all("SELECT name FROM categories WHERE username=? ORDER BY name", (username,))]
+
+def get_category_id(username, name):
+    row = fetch_one("SELECT id FROM categories WHERE username=? AND name=?", (username, name))
+    return None if row is None else row[0]
+
+def category_ids(labels):
+    # (username, name) -> category id for a batch of record labels, creating the categories that are new;
+    # empty labels get no category. Call inside a transaction so the ids read back are the ones inserted
+    labels = {(username, name) for username, name in labels if name}
+    ids = {}
+    for username in {username for username, _ in labels}:
+        ids.update(((username, name), category_id) for category_id, name in
+                   fetch_all("SELECT id, name FROM categories WHERE username=?", (username,)))
+    missing = sorted(labels - ids.keys())
+    if missing:
+        execute_many("INSERT OR IGNORE INTO categories (username, name) VALUES (?, ?)", missing)
+        for username, name in missing:
+            ids[(username, name)] = get_category_id(username, name)
+    return ids
+
+@database.tagged("categories")
+def save_category(category_data):
+    username, name = category_data
+    if not name:
+        raise ValueError("Category name is required.")
+    with transaction():
+        if get_category_id(username, name) is not None:
+            raise ValueError("Category already exists.")
+        execute_query("INSERT INTO categories (username, name) VALUES (?, ?)", (username, name))
+
+@database.tagged("categories")
+def rename_category(username, name, new_name):
+    # records and rollups refer to the id, so a rename is this one row whatever the number of records
+    if not new_name:
+        raise ValueError("Category name is required.")
+    with transaction():
+        category_id = get_category_id(username, name)
+        if category_id is None:
+            raise ValueError("No such category.")
+        if get_category_id(username, new_name) is not None:
+            raise ValueError("Category already exists.")
+        execute_query("UPDATE categories SET name = ? WHERE id = ?", (new_name, category_id))
+        database.after_commit(functools.partial(bump_write_generation, [username]))
+
+@database.tagged("budgets")
+def set_budget(username, category, amount, currency=DEFAULT_CURRENCY):
+    # the category is created if it is new, as saving an expense would
+    if not category:
+        raise ValueError("Category name is required.")
+    if not is_valid_amount(amount):
+        raise ValueError("Invalid amount.")
+    with transaction():
+        category_id = category_ids([(username, category)])[(username, category)]
+        execute_query('''INSERT INTO category_budgets (username, category_id, currency, amount) VALUES (?, ?, ?, ?)
+                         ON CONFLICT DO UPDATE SET amount = excluded.amount''',
+                      (username, category_id, currency, to_cents(amount)))
+
+@database.tagged("budgets")
+def remove_budget(username, category, currency=DEFAULT_CURRENCY):
+    if not execute_query('''DELETE FROM category_budgets WHERE username = ? AND currency = ?
+                             AND category_id = (SELECT id FROM categories WHERE username = ? AND name = ?)''',
+                         (username, currency, username, category)):
+        raise ValueError("No budget for this category.")
+
+def recurring_spend(rules, category_id, month, currency=DEFAULT_CURRENCY):
+    # in cents, the expense rules' occurrences in category_id during month ("YYYY-MM")
+    start, end = month_bounds(datetime.date.fromisoformat(month + "-01"))
+    return sum(cents * occurrence_count(frequency, first, last, start, end)
+               for _, record_table, cents, label_id, _, _, _, rule_currency, frequency, first, last in rules
+               if record_table == "expenses" and label_id == category_id and rule_currency == currency)
+
+@database.tagged("budgets")
+def budget_status(username, month=None, currency=DEFAULT_CURRENCY):
+    # [(category, budget, spent, remaining)] for month ("YYYY-MM", default this month), spent including the
+    # recurring expenses that fall in it; remaining is negative once a budget is overspent
+    month = month or datetime.date.today().isoformat()[:7]
+    rows = fetch_all('''SELECT c.name, b.category_id, b.amount, COALESCE(t.total, 0)
+                        FROM category_budgets AS b JOIN categories AS c ON c.id = b.category_id
+                        LEFT JOIN record_totals_monthly AS t
+                        ON t.username = b.username AND t.record_table = 'expenses' AND t.currency = b.currency
+                        AND t.month = ? AND t.label_id = b.category_id
+                        WHERE b.username = ? AND b.currency = ? ORDER BY c.name''', (month, username, currency))
+    rules = load_recurring_rules(username, "expenses") if rows else []
+    status = []
+    for name, category_id, budget, spent in rows:
+        spent += recurring_spend(rules, category_id, month, currency)
+        status.append((name, from_cents(budget), from_cents(spent), from_cents(budget - spent)))
+    return status
+
+def check_budgets(monthly):
+    # the budgets an expense batch left overspent, as [(username, category, month, spent, budget)]. Runs in the
+    # batch's transaction right after its rollup upserts, so it reads each touched (user, currency, month,
+    # category) counter by primary key instead of summing the expenses: the cost follows the distinct keys of
+    # the batch, not the records behind them
+    keys = [key for key in monthly if key[3]]
+    if not keys:
+        return []
+    rows = fetch_all('''SELECT b.username, c.name, key.value ->> 2, b.currency, b.category_id, b.amount, t.total
+                        FROM json_each(?) AS key
+                        JOIN category_budgets AS b ON b.username = key.value ->> 0 AND b.currency = key.value ->> 1
+                        AND b.category_id = key.value ->> 3
+                        JOIN record_totals_monthly AS t
+                        ON t.username = b.username AND t.record_table = 'expenses' AND t.currency = b.currency
+                        AND t.month = key.value ->> 2 AND t.label_id = b.category_id
+                        JOIN categories AS c ON c.id = b.category_id''', (json.dumps(keys),))
+    rules = {username: load_recurring_rules(username, "expenses") for username in {row[0] for row in rows}}
+    alerts = []
+    for username, name, month, currency, category_id, budget, spent in rows:
+        spent += recurring_spend(rules[username], category_id, month, currency)
+        if spent > budget:
+            alerts.append((username, name, month, from_cents(spent), from_cents(budget)))
+    return alerts
+
+PHONE_PATTERN = re.compile(r"09[0-9]{9}")
+# at least 6 characters with a lowercase letter, an uppercase letter, a digit and a symbol, in one scan
+PASSWORD_PATTERN = re.compile(r"(?=.*[a-z])(?=.*[A-Z])(?=.*[0-9])(?=.*[!@#$%^&*()_+]).{6,}", re.DOTALL)
+EMAIL_PATTERN = re.compile(r"[a-zA-Z0-9]+@(gmail|yahoo)\.com")
+
+def is_valid_name(name):
+    return name.isalpha()
+
+def is_valid_phone(phone):
+    return PHONE_PATTERN.fullmatch(phone) is not None
+
+def is_valid_password(password):
+    return PASSWORD_PATTERN.fullmatch(password) is not None
+
+def is_valid_email(email):
+    return EMAIL_PATTERN.fullmatch(email) is not None
+
+def is_valid_birthdate(date_text):
+    date = iso_date(date_text)
+    return date is not None and "1920" <= date[:4] <= "2005"
+
+def parse_amount(amount):
+    # Decimal(str(...)) takes a float such as 0.1 as written rather than as its binary value
+    try:
+        value = decimal.Decimal(str(amount).strip())
+    except decimal.InvalidOperation:
+        return None
+    if not value.is_finite() or value <= 0 or value * 100 > MAX_CENTS or (value * 100) % 1:
+        return None
+    return value
+
+def to_cents(amount):
+    value = parse_amount(amount)
+    if value is None:
+        raise ValueError(f"Invalid amount: {amount}")
+    return int(value * 100)
+
+def from_cents(cents):
+    return decimal.Decimal(cents).scaleb(-2)
+
+def format_amount(cents):
+    return str(from_cents(cents))
+
+def amount_bound(amount):
+    # search bounds may be zero or fall between cents, unlike stored amounts
+    try:
+        value = decimal.Decimal(str(amount).strip()) * 100
+    except decimal.InvalidOperation:
+        value = None
+    if value is None or not value.is_finite():
+        raise ValueError(f"Invalid amount: {amount}")
+    return int(value) if value == value.to_integral_value() else float(value)
+
+def is_valid_amount(amount):
+    return parse_amount(amount) is not None
+
+CURRENCY_CODE = re.compile(r"^[A-Z]{3}$")
+
+def is_valid_currency(currency):
+    return CURRENCY_CODE.match(currency) is not None
+
+def is_valid_date(date_text):
+    return iso_date(date_text) is not None
+
+def get_cities():
+    return ["Tehran", "Mashhad", "Isfahan", "Karaj", "Tabriz", "Shiraz", "Qom", "Ahvaz", "Kermanshah", "Urmia"]
+
+CITIES = frozenset(get_cities())
+
+def is_valid_city(city):
+    return city in CITIES
+
+PASSWORD_RULES = ("Invalid password. Must contain at least one lowercase letter, one uppercase letter, one digit, "
+                  "one symbol, and be at least 6 characters long.")
+
+# record type -> (index in the record tuple, field, check, message), in the order the fields are shown
+RECORD_SCHEMA = (
+    (1, "amount", is_valid_amount, "Invalid amount."),
+    (2, "date", is_valid_date, "Invalid date format. Use YYYY-MM-DD."),
+)
+VALIDATION_SCHEMAS = {
+    "users": (
+        (1, "first_name", is_valid_name, "Invalid first name. Use English letters only."),
+        (2, "last_name", is_valid_name, "Invalid last name. Use English letters only."),
+        (3, "phone", is_valid_phone, "Invalid phone number. Must start with 09 and be 11 digits long."),
+        (4, "password", is_valid_password, PASSWORD_RULES),
+        (5, "city", is_valid_city, "Invalid city."),
+        (6, "email", is_valid_email, "Invalid email."),
+        (7, "birthdate", is_valid_birthdate, "Invalid birthdate."),
+    ),
+    "incomes": RECORD_SCHEMA,
+    "expenses": RECORD_SCHEMA,
+}
+
+def validate_records(record_type, records):
+    # checks a whole batch column by column, so each distinct value is checked once per batch;
+    # returns {row index: [(field, message), ...]} for the rows that failed, with every failing field
+    errors = {}
+    for index, field, check, message in VALIDATION_SCHEMAS[record_type]:
+        verdicts = {}
+        for row, record in enumerate(records):
+            value = record[index]
+            valid = verdicts.get(value)
+            if valid is None:
+                valid = verdicts[value] = check(value)
+            if not valid:
+                errors.setdefault(row, []).append((field, message))
+    return dict(sorted(errors.items()))
+
+def validate_record(record_type, record):
+    return validate_records(record_type, [record]).get(0, [])
+
+@database.tagged("signup")
+def validate_users(users):
+    # the schema checks plus usernames that are taken, either already or earlier in the same batch
+    errors = validate_records("users", users)
+    usernames = [user[0] for user in users]
+    taken = set()
+    for start in range(0, len(usernames), 500):
+        chunk = usernames[start:start + 500]
+        taken.update(row[0] for row in fetch_all(
+            f"SELECT username FROM users WHERE username IN ({', '.join('?' * len(chunk))})", chunk))
+    for row, username in enumerate(usernames):
+        if username in taken:
+            errors.setdefault(row, []).insert(0, ("username", "Username already exists."))
+        taken.add(username)
+    return dict(sorted(errors.items()))
+
+FTS_TOKEN = re.compile(r"\w+")
+
+def build_match_expression(term, columns=()):
+    tokens = FTS_TOKEN.findall(term)
+    if not tokens:
+        return None
+    # every word must match, each as a prefix
+    expression = " ".join('"{}"*'.format(token.replace('"', '""')) for token in tokens)
+    if columns:
+        expression = "{{{}}} : ({})".format(" ".join(columns), expression)
+    return expression
+
+# what a search term can be matched against; either label means the record's category
+SEARCH_FIELDS = ("amount", "date", *RECORD_LABELS.values(), "description", "type")
+
+def build_search_query(username, record_type, term="", fields=(), start_date="", end_date="", min_amount="", max_amount="",
+                       columns=None, full_text=True):
+    columns = columns or ", ".join(RECORD_COLUMNS[record_type])
+    where, params = search_conditions(username, record_type, term, fields, start_date, end_date, min_amount, max_amount,
+                                      full_text)
+    dates = recurring_dates(username, record_type, parse_date(start_date), parse_date(end_date))
+    if not dates:
+        return "SELECT {} FROM {} WHERE {}".format(columns, RECORD_VIEWS[record_type], where), params
+    # occurrences are not in the full-text index, so their side matches the term with LIKE
+    occurrence_where, occurrence_params = search_conditions(username, record_type, term, fields, start_date, end_date,
+                                                            min_amount, max_amount, full_text=False)
+    return with_occurrences(username, record_type, columns, where, params, dates, occurrence_where, occurrence_params)
+
+def search_conditions(username, record_type, term="", fields=(), start_date="", end_date="", min_amount="",
+                      max_amount="", full_text=True):
+    label = RECORD_LABELS[record_type]
+    # field names end up in the SQL text, so only these get that far
+    unknown = [field for field in fields if field not in SEARCH_FIELDS]
+    if unknown:
+        raise ValueError("Unknown search field: {}".format(", ".join(unknown)))
+    where = "username=?"
+    params = [username]
+    if term and fields:
+        term_columns = [label if field in RECORD_LABELS.values() else field for field in fields]
+        text_columns = [column for column in term_columns if column in FTS_COLUMNS[record_type]]
+        match = build_match_expression(term, text_columns) if full_text and text_columns else None
+        if match:
+            match = '{} AND username : "{}"'.format(match, username.replace('"', '""'))
+            like_columns = [column for column in term_columns if column not in text_columns]
+            term_conditions = [f"id IN (SELECT rowid FROM {record_type}_fts WHERE {record_type}_fts MATCH ?)"]
+            params.append(match)
+        else:
+            like_columns = term_columns
+            term_conditions = []
+        for column in like_columns:
+            if column == label:
+                # matched against the user's few category names, then looked up by id
+                term_conditions.append(f"{label}_id IN (SELECT id FROM categories WHERE username=? AND name LIKE ?)")
+                params += [username, f"%{term}%"]
+            else:
+                term_conditions.append(f"{AMOUNT_TEXT if column == 'amount' else column} LIKE ?")
+                params.append(f"%{term}%")
+        where += " AND ({})".format(" OR ".join(term_conditions))
+    # bounds are compared as ISO text, so "2024-1-5" has to become "2024-01-05" first
+    for bound, comparison in ((start_date, ">="), (end_date, "<=")):
+        if bound:
+            if not is_valid_date(bound):
+                raise ValueError("Invalid date format. Use YYYY-MM-DD.")
+            where += f" AND date {comparison} ?"
+            params.append(iso_date(bound))
+    if min_amount:
+        where += " AND amount >= ?"
+        params.append(amount_bound(min_amount))
+    if max_amount:
+        where += " AND amount <= ?"
+        params.append(amount_bound(max_amount))
+    return where, params
+
+@database.tagged("search")
+def search_ranked(username, record_type, term, fields=(), limit=50):
+    label = RECORD_LABELS[record_type]
+    columns = [label if field in RECORD_LABELS.values() else field for field in fields] or FTS_COLUMNS[record_type][1:]
+    match = build_match_expression(term, [column for column in columns if column in FTS_COLUMNS[record_type]])
+    if match is None:
+        return []
+    match = '{} AND username : "{}"'.format(match, username.replace('"', '""'))
+    columns = ", ".join(f"r.{column}" for column in RECORD_COLUMNS[record_type])
+    return fetch_all(f'''SELECT {columns} FROM {record_type}_fts
+                         JOIN {RECORD_VIEWS[record_type]} AS r ON r.id = {record_type}_fts.rowid
+                         WHERE {record_type}_fts MATCH ? AND r.username = ?
+                         ORDER BY {record_type}_fts.rank LIMIT ?''', (match, username, limit))
+
+def get_report_range(filter_type, start_date="", end_date="", today=None):
+    today = today or datetime.datetime.now().date()
+    if filter_type == "day":
+        return today, today
+    if filter_type == "month":
+        return month_bounds(today)
+    if filter_type == "year":
+        return today.replace(month=1, day=1), today.replace(month=12, day=31)
+    start, end = parse_date(start_date), parse_date(end_date)
+    if start is None or end is None:
+        raise ValueError("Invalid date format. Use YYYY-MM-DD.")
+    return start, end
+
+def build_report_query(username, record_type, filter_type, start_date="", end_date="", columns=None):
+    if record_type not in RECORD_LABELS:
+        raise ValueError(f"Unknown record type: {record_type}")
+    start, end = get_report_range(filter_type, start_date, end_date)
+    columns = columns or ", ".join(RECORD_COLUMNS[record_type])
+    where, params = "username=? AND date BETWEEN ? AND ?", [username, str(start), str(end)]
+    dates = recurring_dates(username, record_type, start, end)
+    if not dates:
+        return f"SELECT {columns} FROM {RECORD_VIEWS[record_type]} WHERE {where}", params
+    return with_occurrences(username, record_type, columns, where, params, dates, where, params)
+
+# SQL that maps an ISO date column to its period key; weeks are keyed by their Monday
+REPORT_PERIODS = {
+    "day": "{}",
+    "week": "date({}, 'weekday 0', '-6 days')",
+    "month": "substr({}, 1, 7)",
+    "year": "substr({}, 1, 4)",
+}
+REPORT_GROUPS = ("none", "label", "type")
+
+def build_grouped_report_query(username, start, end, period="month", group_by="none", min_amount="", max_amount="",
+                               currency=DEFAULT_CURRENCY):
+    # one grouped pass over incomes and expenses together; each row is
+    # (period, record_table, group, matched total, matched count, total, count) in cents, where "matched"
+    # only counts records inside the amount bounds and the plain total counts every record in the range
+    if period not in REPORT_PERIODS:
+        raise ValueError(f"Unknown report period: {period}")
+    if group_by not in REPORT_GROUPS:
+        raise ValueError(f"Unknown report grouping: {group_by}")
+    params = {"username": username, "currency": currency, "start": str(start), "end": str(end)}
+
+    # groups by category id and only then looks the names up, once per group rather than once per row
+    if group_by == "label":
+        select = "grouped.period, grouped.record_table, COALESCE(categories.name, '')"
+        join = "LEFT JOIN categories ON categories.id = grouped.grp"
+    else:
+        select, join = "grouped.period, grouped.record_table, grouped.grp", ""
+
+    if not min_amount and not max_amount and group_by != "type":
+        # the daily rollup already holds per (day, category) totals, far fewer rows than the records
+        group = "label_id" if group_by == "label" else "''"
+        query = f'''SELECT {select}, grouped.matched_total, grouped.matched_count, grouped.total, grouped.count
+                    FROM (SELECT {REPORT_PERIODS[period].format("day")} AS period, record_table, {group} AS grp,
+                                 SUM(total) AS matched_total, SUM(count) AS matched_count,
+                                 SUM(total) AS total, SUM(count) AS count
+                          FROM record_totals_daily
+                          WHERE username = :username AND record_table IN ('incomes', 'expenses')
+                          AND currency = :currency AND day BETWEEN :start AND :end
+                          GROUP BY period, record_table, grp) AS grouped
+                    {join} ORDER BY grouped.period'''
+        return query, params
+
+    match = []
+    if min_amount:
+        match.append("amount >= :min_amount")
+        params["min_amount"] = amount_bound(min_amount)
+    if max_amount:
+        match.append("amount <= :max_amount")
+        params["max_amount"] = amount_bound(max_amount)
+    match = " AND ".join(match) or "1"
+    parts = []
+    for table, label in RECORD_LABELS.items():
+        group = {"none": "''", "label": f"{label}_id", "type": "COALESCE(type, '')"}[group_by]
+        parts.append(f'''SELECT '{table}' AS record_table, {REPORT_PERIODS[period].format("date")} AS period,
+                                {group} AS grp, amount
+                         FROM {table}
+                         WHERE username = :username AND currency = :currency AND date BETWEEN :start AND :end''')
+    query = f'''SELECT {select}, grouped.matched_total, grouped.matched_count, grouped.total, grouped.count
+                FROM (SELECT period, record_table, grp,
+                             SUM(amount) FILTER (WHERE {match}) AS matched_total,
+                             COUNT(*) FILTER (WHERE {match}) AS matched_count, SUM(amount) AS total, COUNT(*) AS count
+                      FROM ({" UNION ALL ".join(parts)})
+                      GROUP BY period, record_table, grp) AS grouped
+                {join} ORDER BY grouped.period'''
+    return query, params
+
+def percentage(part, whole):
+    return (part * 100 / whole).quantize(CENT) if whole else None
+
+@database.tagged("report")
+def grouped_report(username, start, end, period="month", group_by="none", min_amount="", max_amount="",
+                   currency=DEFAULT_CURRENCY):
+    # the rollups already answer reports without amount bounds or type groups faster than the columns could
+    if ANALYTICS_CACHE_BYTES and (min_amount or max_amount or group_by == "type"):
+        rows = analytics_report_rows(username, start, end, period, group_by, min_amount, max_amount, currency)
+    else:
+        rows = fetch_all(*build_grouped_report_query(username, start, end, period, group_by, min_amount, max_amount,
+                                                     currency))
+    rows += recurring_report_rows(username, start, end, period, group_by, min_amount, max_amount, currency)
+    periods = sorted({row[0] for row in rows})
+    position = {key: index for index, key in enumerate(periods)}
+    balances = balance_series(username, start, end, period, currency) if periods else {}
+    lines = {}
+    matched = dict.fromkeys(RECORD_LABELS, 0)
+    overall = dict.fromkeys(RECORD_LABELS, 0)
+    by_period = {table: [0] * len(periods) for table in RECORD_LABELS}
+    for key, table, group, matched_total, matched_count, total, _ in rows:
+        line = lines.setdefault((table, group), {"record_table": table, "group": group,
+                                                 "values": [0] * len(periods), "total": 0, "count": 0})
+        line["values"][position[key]] += matched_total or 0
+        line["total"] += matched_total or 0
+        line["count"] += matched_count
+        by_period[table][position[key]] += matched_total or 0
+        matched[table] += matched_total or 0
+        overall[table] += total
+
+    lines = sorted(lines.values(), key=lambda line: (line["record_table"] != "incomes", -line["total"], line["group"]))
+    for line in lines:
+        line["values"] = [from_cents(value) for value in line["values"]]
+        line["total"] = from_cents(line["total"])
+        line["share"] = percentage(line["total"], from_cents(matched[line["record_table"]]))
+    net = [income - expense for income, expense in zip(by_period["incomes"], by_period["expenses"])]
+    return {
+        "periods": periods,
+        "lines": lines,
+        "incomes": [from_cents(value) for value in by_period["incomes"]],
+        "expenses": [from_cents(value) for value in by_period["expenses"]],
+        "net": [from_cents(value) for value in net],
+        "totals": {table: from_cents(total) for table, total in matched.items()},
+        "overall_totals": {table: from_cents(total) for table, total in overall.items()},
+        "proportions": {table: percentage(from_cents(matched[table]), from_cents(overall[table]))
+                        for table in RECORD_LABELS},
+        "balance": from_cents(matched["incomes"] - matched["expenses"]),
+        # the account balance at the end of each period, whatever the amount bounds
+        "balances": [balances[key] for key in periods],
+    }
+
+# opt-in cache of whole per-user ledgers as columns, for reports that re-run over the same user; the
+# budget is in bytes across all users, and 0 leaves reports on SQLite
+ANALYTICS_CACHE_BYTES = 0
+# one record across all of RecordColumns' arrays
+RECORD_COLUMN_BYTES = sum(array.array(code).itemsize for code in "iiqqii")
+
+class RecordColumns:
+    # one user's records of one table as parallel typed arrays. Categories are already small integer ids
+    # into the categories table; types and currencies are dictionary-encoded here
+    def __init__(self):
+        self.days = array.array("i")  # date.toordinal()
+        self.months = array.array("i")  # year * 12 + month - 1
+        self.cents = array.array("q")
+        self.labels = array.array("q")  # category id, 0 for none
+        self.types = array.array("i")
+        self.currencies = array.array("i")
+        self.type_codes = {}
+        self.currency_codes = {}
+        self.last_id = 0
+
+    def extend(self, rows):
+        # rows of (record id, date, cents, category id, type, currency) as RECORD_COLUMNS_SQL selects them;
+        # each distinct date, type and currency is converted once and the columns are mapped through that
+        if not rows:
+            return
+        dates = list(map(operator.itemgetter(1), rows))
+        keys = {date: day_keys(date) for date in set(dates)}
+        self.days.extend(map({date: key[0] for date, key in keys.items()}.__getitem__, dates))
+        self.months.extend(map({date: key[1] for date, key in keys.items()}.__getitem__, dates))
+        self.cents.extend(map(operator.itemgetter(2), rows))
+        self.labels.extend(map(operator.itemgetter(3), rows))
+        for column, index, codes in ((self.types, 4, self.type_codes), (self.currencies, 5, self.currency_codes)):
+            values = list(map(operator.itemgetter(index), rows))
+            encoded = {value: codes.setdefault(value, len(codes)) for value in set(values)}
+            column.extend(map(encoded.__getitem__, values))
+        self.last_id = max(self.last_id, max(map(operator.itemgetter(0), rows)))
+
+    def nbytes(self):
+        return len(self.days) * RECORD_COLUMN_BYTES
+
+_analytics_cache = OrderedDict()
+_analytics_lock = threading.RLock()
+_analytics_bytes = 0
+
+def configure_analytics_cache(max_bytes):
+    global ANALYTICS_CACHE_BYTES
+    with _analytics_lock:
+        ANALYTICS_CACHE_BYTES = max_bytes
+        evict_analytics_cache()
+
+def entry_bytes(entry):
+    return sum(columns.nbytes() for columns in entry["tables"].values())
+
+def evict_analytics_cache():
+    global _analytics_bytes
+    with _analytics_lock:
+        while _analytics_cache and _analytics_bytes > ANALYTICS_CACHE_BYTES:
+            _analytics_bytes -= entry_bytes(_analytics_cache.popitem(last=False)[1])
+
+def evict_from_analytics_cache(username):
+    global _analytics_bytes
+    with _analytics_lock:
+        entry = _analytics_cache.pop(username, None)
+        if entry is not None:
+            _analytics_bytes -= entry_bytes(entry)
+
+def clear_analytics_cache(connection=None):
+    global _analytics_bytes
+    with _analytics_lock:
+        _analytics_cache.clear()
+        _analytics_bytes = 0
+
+database.on_open(clear_analytics_cache)
+
+RECORD_COLUMNS_SQL = "SELECT rowid, date, amount, COALESCE({label}_id, 0), COALESCE(type, ''), currency FROM {table}"
+
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+def day_keys(date):
+    # (day ordinal, year * 12 + month - 1) of an ISO date
+    day = datetime.date.fromisoformat(date)
+    return day.toordinal(), day.year * 12 + day.month - 1
+
+def read_record_columns(username, tables, after_id=False):
+    # after_id=True only reads the records added since each table's columns were filled
+    for table, label in RECORD_LABELS.items():
+        columns = tables.setdefault(table, RecordColumns())
+        query = RECORD_COLUMNS_SQL.format(label=label, table=table)
+        if after_id:
+            # the unary + keeps SQLite on the rowid range instead of the user's whole index range
+            columns.extend(fetch_all(query + " WHERE rowid > ? AND +username = ?", (columns.last_id, username)))
+        else:
+            # in date order, which also steers SQLite to the (username, date) index
+            columns.extend(fetch_all(query + " WHERE username = ? ORDER BY date", (username,)))
+    return tables
+
+def get_record_columns(username, version):
+    # callers hold _analytics_lock while they read the columns, since appends resize them. Each user's entry
+    # remembers the write generation its columns are current for; anything committed since that
+    # append-on-write did not cover is read by rowid. version is the database's data_version, read before the
+    # lock: another process may have changed or deleted anything, so once it moves the columns are read again
+    global _analytics_bytes
+    entry = _analytics_cache.get(username)
+    if entry is not None and entry["version"] != version:
+        evict_from_analytics_cache(username)
+        entry = None
+    if entry is not None:
+        _analytics_cache.move_to_end(username)
+    else:
+        entry = {"version": version, "generation": write_generation(username),
+                 "tables": read_record_columns(username, {})}
+        if entry_bytes(entry) <= ANALYTICS_CACHE_BYTES:
+            _analytics_cache[username] = entry
+            _analytics_bytes += entry_bytes(entry)
+    generation = write_generation(username)
+    if entry["generation"] != generation:
+        size = entry_bytes(entry)
+        read_record_columns(username, entry["tables"], after_id=True)
+        entry["generation"] = generation
+        if username in _analytics_cache:
+            _analytics_bytes += entry_bytes(entry) - size
+    evict_analytics_cache()
+    return entry["tables"]
+
+def append_to_analytics_cache(record_table, rows):
+    # rows as inserted by save_incomes/save_expenses, which hold the table's highest rowids; only users already
+    # in the cache are appended to, and only with records newer than what their columns hold
+    if not ANALYTICS_CACHE_BYTES or not any(row[0] in _analytics_cache for row in rows):
+        return
+    first_id = fetch_one(f"SELECT MAX(rowid) FROM {record_table}")[0] - len(rows) + 1
+
+    def append():
+        # runs after the write generations were bumped and before the writer lock is released, so an entry that
+        # was current just before this write is exactly one generation behind
+        global _analytics_bytes
+        with _analytics_lock:
+            added = {}
+            for record_id, (username, cents, date, label_id, _, type_, currency) in enumerate(rows, first_id):
+                entry = _analytics_cache.get(username)
+                if entry is not None and record_id > entry["tables"][record_table].last_id:
+                    added.setdefault(username, []).append((record_id, date, cents, label_id or 0, type_ or "",
+                                                           currency))
+            for username, new_rows in added.items():
+                entry = _analytics_cache[username]
+                entry["tables"][record_table].extend(new_rows)
+                _analytics_bytes += len(new_rows) * RECORD_COLUMN_BYTES
+                if entry["generation"] == write_generation(username) - 1:
+                    entry["generation"] = write_generation(username)
+            evict_analytics_cache()
+
+    database.after_commit(append)
+
+def period_key_text(period, key):
+    if period in ("day", "week"):
+        return datetime.date.fromordinal(key).isoformat()
+    if period == "month":
+        return f"{key // 12:04d}-{key % 12 + 1:02d}"
+    return f"{key:04d}"
+
+def aggregate_record_columns(columns, start, end, currency, period, group_by, min_cents=None, max_cents=None):
+    # {(period key, group code): [matched total, matched count, total, count]} over the records between start
+    # and end in currency, with the same "matched" amount bounds as build_grouped_report_query
+    currency_code = columns.currency_codes.get(currency)
+    if currency_code is None or not len(columns.days):
+        return {}
+    first, last = start.toordinal(), end.toordinal()
+    if numpy is None:
+        period_key = {"day": lambda day, month: day, "week": lambda day, month: day - (day - 1) % 7,
+                      "month": lambda day, month: month, "year": lambda day, month: month // 12}[period]
+        group_codes = {"none": itertools.repeat(0), "label": columns.labels, "type": columns.types}[group_by]
+        groups = {}
+        for day, month, cents, group, record_currency in zip(columns.days, columns.months, columns.cents, group_codes,
+                                                              columns.currencies):
+            if record_currency != currency_code or day < first or day > last:
+                continue
+            totals = groups.setdefault((period_key(day, month), group), [0, 0, 0, 0])
+            if (min_cents is None or cents >= min_cents) and (max_cents is None or cents <= max_cents):
+                totals[0] += cents
+                totals[1] += 1
+            totals[2] += cents
+            totals[3] += 1
+        return groups
+
+    days = numpy.frombuffer(columns.days, dtype=numpy.int32)
+    currencies = numpy.frombuffer(columns.currencies, dtype=numpy.int32)
+    selected = (days >= first) & (days <= last) & (currencies == currency_code)
+    days = days[selected].astype(numpy.int64)
+    if not len(days):
+        return {}
+    months = numpy.frombuffer(columns.months, dtype=numpy.int32)[selected].astype(numpy.int64)
+    cents = numpy.frombuffer(columns.cents, dtype=numpy.int64)[selected]
+    keys = {"day": days, "week": days - (days - 1) % 7, "month": months, "year": months // 12}[period]
+    if group_by == "none":
+        codes = numpy.zeros(len(keys), dtype=numpy.int64)
+    else:
+        source = columns.labels if group_by == "label" else columns.types
+        codes = numpy.frombuffer(source, dtype=numpy.int64 if group_by == "label" else numpy.int32)[selected]
+        codes = codes.astype(numpy.int64)
+    matched = numpy.ones(len(cents), dtype=bool)
+    if min_cents is not None:
+        matched &= cents >= min_cents
+    if max_cents is not None:
+        matched &= cents <= max_cents
+
+    # sort by (period, group) and sum each run of equal keys in int64, so large totals stay exact
+    order = numpy.lexsort((codes, keys))
+    keys, codes, cents, matched = keys[order], codes[order], cents[order], matched[order]
+    starts = numpy.flatnonzero(numpy.concatenate(([True], (keys[1:] != keys[:-1]) | (codes[1:] != codes[:-1]))))
+    ends = numpy.append(starts[1:], len(keys))
+    totals = numpy.add.reduceat(cents, starts)
+    matched_totals = numpy.add.reduceat(numpy.where(matched, cents, 0), starts)
+    matched_counts = numpy.add.reduceat(matched.astype(numpy.int64), starts)
+    return {(int(keys[index]), int(codes[index])): [int(matched_total), int(matched_count), int(total),
+                                                     int(end - index)]
+            for index, end, matched_total, matched_count, total
+            in zip(starts, ends, matched_totals, matched_counts, totals)}
+
+def analytics_report_rows(username, start, end, period="month", group_by="none", min_amount="", max_amount="",
+                          currency=DEFAULT_CURRENCY):
+    # the rows build_grouped_report_query would return, computed from the cached columns
+    if period not in REPORT_PERIODS:
+        raise ValueError(f"Unknown report period: {period}")
+    if group_by not in REPORT_GROUPS:
+        raise ValueError(f"Unknown report grouping: {group_by}")
+    min_cents = amount_bound(min_amount) if min_amount else None
+    max_cents = amount_bound(max_amount) if max_amount else None
+    names = {}
+    if group_by == "label":
+        names = dict(fetch_all("SELECT id, name FROM categories WHERE username = ?", (username,)))
+    rows = []
+    # read outside _analytics_lock: a writer appending after its commit takes that lock while it holds the writer
+    version = database.data_version()
+    with _analytics_lock:
+        tables = get_record_columns(username, version)
+        for table, columns in tables.items():
+            if group_by == "type":
+                names = {code: type_ for type_, code in columns.type_codes.items()}
+            groups = aggregate_record_columns(columns, start, end, currency, period, group_by, min_cents, max_cents)
+            for (key, code), totals in groups.items():
+                group = names.get(code, "") if group_by != "none" else ""
+                rows.append((period_key_text(period, key), table, group, *totals))
+    return rows
+
+RESULTS_PAGE_SIZE = 200
+
+# queries passed to fetch_page must select these first; pages are keyed on (date, id)
+PAGE_COLUMNS = "id, date, *"
+
+def fetch_page(query, params, after=None, before=None, page_size=RESULTS_PAGE_SIZE):
+    params = list(params)
+    if before is not None:
+        query += " AND (date, id) < (?, ?) ORDER BY date DESC, id DESC LIMIT ?"
+        params += [before[0], before[1], page_size]
+        return fetch_all(query, params)[::-1]
+    if after is not None:
+        query += " AND (date, id) > (?, ?)"
+        params += [after[0], after[1]]
+    query += " ORDER BY date, id LIMIT ?"
+    params.append(page_size)
+    return fetch_all(query, params)
+
+# cached result pages, across all users; each holds up to RESULTS_PAGE_SIZE rows
+PAGE_CACHE_SIZE = 256
+
+_page_cache = OrderedDict()
+_page_cache_lock = threading.Lock()
+# per user, bumped after every committed write to their records or categories
+_write_generations = {}
+
+def write_generation(username):
+    return _write_generations.get(username, 0)
+
+def bump_write_generation(usernames):
+    with _page_cache_lock:
+        for username in usernames:
+            _write_generations[username] = _write_generations.get(username, 0) + 1
+
+def clear_page_cache(connection=None):
+    with _page_cache_lock:
+        _page_cache.clear()
+
+# a new pool may be a different database file
+database.on_open(clear_page_cache)
+
+def fetch_cached_page(username, query, params, after=None, before=None, page_size=RESULTS_PAGE_SIZE):
+    # the query text and parameters carry the table, term, fields and bounds. A page is stored with the
+    # generation read before it was fetched, so a write committed meanwhile can only make it miss. Other
+    # processes' commits never bump a generation, so the database's data_version is part of it; while the
+    # writer is busy that cannot be read without waiting, and the page comes straight from SQLite
+    version = database.data_version(blocking=False)
+    if version is None:
+        return fetch_page(query, params, after, before, page_size)
+    key = (username, query, tuple(params), after, before, page_size)
+    generation = (version, write_generation(username))
+    with _page_cache_lock:
+        entry = _page_cache.get(key)
+        if entry is not None and entry[0] == generation:
+            _page_cache.move_to_end(key)
+            return entry[1]
+    rows = fetch_page(query, params, after, before, page_size)
+    with _page_cache_lock:
+        _page_cache[key] = (generation, rows)
+        _page_cache.move_to_end(key)
+        while len(_page_cache) > PAGE_CACHE_SIZE:
+            _page_cache.popitem(last=False)
+    return rows
+
+EXPORT_CHUNK_SIZE = 10_000
+EXPORT_FORMATS = ("csv", "parquet")
+
+def iter_query_chunks(query, params=(), chunk_size=EXPORT_CHUNK_SIZE):
+    # amounts leave as Decimal, so CSV gets "12.50" and Parquet a decimal column, never float cents
+    for columns, rows in database.iter_chunks(query, params, chunk_size):
+        if "amount" in columns:
+            index = columns.index("amount")
+            rows = [row[:index] + (None if row[index] is None else from_cents(row[index]),) + row[index + 1:]
+                    for row in rows]
+        yield columns, rows
+
+def export_csv(chunks, path):
+    exported = 0
+    with open(path, "w", newline="", encoding="utf-8") as handle:
+        writer = csv.writer(handle)
+        header_written = False
+        for columns, rows in chunks:
+            if not header_written:
+                writer.writerow(columns)
+                header_written = True
+            writer.writerows(rows)
+            exported += len(rows)
+    return exported
+
+def export_column_type(name):
+    # fixed per column, not inferred per chunk: pyarrow sizes a decimal to the largest value it sees, so a later
+    # chunk could hold an amount the first chunk's type has no room for. Any int64 of cents fits 19 digits
+    if name == "amount":
+        return pyarrow.decimal128(19, 2)
+    if name == "id" or name.endswith("_id"):
+        return pyarrow.int64()
+    return pyarrow.string()
+
+def export_parquet(chunks, path):
+    if pyarrow is None:
+        raise RuntimeError("Parquet export requires the pyarrow package.")
+    exported = 0
+    writer = None
+    try:
+        for columns, rows in chunks:
+            if writer is None:
+                schema = pyarrow.schema([(name, export_column_type(name)) for name in columns])
+                writer = pyarrow.parquet.ParquetWriter(path, schema)
+            table = pyarrow.table({name: [row[index] for row in rows] for index, name in enumerate(columns)},
+                                  schema=schema)
+            writer.write_table(table)
+            exported += len(rows)
+    finally:
+        if writer is not None:
+            writer.close()
+    return exported
+
+@database.tagged("export")
+def export_query(query, params, path, file_format=None, chunk_size=EXPORT_CHUNK_SIZE):
+    if file_format is None:
+        file_format = "parquet" if path.lower().endswith(".parquet") else "csv"
+    if file_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {file_format}")
+    chunks = iter_query_chunks(query, params, chunk_size)
+    if file_format == "parquet":
+        return export_parquet(chunks, path)
+    return export_csv(chunks, path)
+
+IMPORT_BATCH_SIZE = 50_000
+IMPORT_READ_SIZE = 1 << 20
+IMPORT_CACHE_SIZE_KB = 256 * 1024
+
+OFX_TAG = re.compile(rb"<(/?)([A-Za-z0-9.]+)>([^<]*)")
+
+def get_import_checkpoint(path, username, record_table):
+    return fetch_one('''SELECT offset, line, imported, rejected FROM import_checkpoints
+                        WHERE path=? AND username=? AND record_table=?''', (path, username, record_table))
+
+def save_import_checkpoint(path, username, record_table, offset, line, imported, rejected):
+    execute_query('''INSERT OR REPLACE INTO import_checkpoints (path, username, record_table, offset, line, imported, rejected)
+                     VALUES (?, ?, ?, ?, ?, ?, ?)''', (path, username, record_table, offset, line, imported, rejected))
+
+def clear_import_checkpoint(path, username, record_table):
+    execute_query("DELETE FROM import_checkpoints WHERE path=? AND username=? AND record_table=?",
+                  (path, username, record_table))
+
+def iter_csv_records(handle, record_table, offset, line, encoding="utf-8-sig"):
+    position = [0]
+
+    def lines():
+        for raw in handle:
+            position[0] += len(raw)
+            yield raw.decode(encoding)
+
+    reader = csv.reader(lines())
+    header = [name.strip().lower() for name in next(reader, [])]
+    label = RECORD_LABELS[record_table]
+    if label not in header:
+        label = "category" if label == "source" else "source"
+    columns = [header.index(name) if name in header else None
+               for name in ("amount", "date", label, "description", "type")]
+    if columns[0] is None or columns[1] is None:
+        raise ValueError("CSV header must contain amount and date columns")
+
+    if offset <= position[0]:
+        line += 1
+    else:
+        handle.seek(offset)
+        position[0] = offset
+        reader = csv.reader(lines())
+
+    for row in reader:
+        line += 1
+        if not row:
+            continue
+        values = tuple(row[index].strip() if index is not None and index < len(row) else ""
+                       for index in columns)
+        yield position[0], line, record_table, values
+
+def parse_ofx_date(value):
+    value = value.strip()
+    return f"{value[0:4]}-{value[4:6]}-{value[6:8]}" if len(value) >= 8 else value
+
+def iter_ofx_records(handle, offset, line):
+    handle.seek(offset)
+    base = offset
+    buffer = b""
+    transaction_fields = None
+    while True:
+        chunk = handle.read(IMPORT_READ_SIZE)
+        buffer += chunk
+        consumed = 0
+        for match in OFX_TAG.finditer(buffer):
+            if chunk and match.end() == len(buffer):
+                break
+            consumed = match.end()
+            closing, tag, value = match.group(1), match.group(2).upper(), match.group(3).strip()
+            if tag == b"STMTTRN":
+                if not closing:
+                    transaction_fields = {}
+                elif transaction_fields is not None:
+                    line += 1
+                    amount = transaction_fields.get(b"TRNAMT", "")
+                    record_table = "expenses" if amount.startswith("-") else "incomes"
+                    values = (amount.lstrip("-+"),
+                              parse_ofx_date(transaction_fields.get(b"DTPOSTED", "")),
+                              transaction_fields.get(b"NAME", transaction_fields.get(b"PAYEE", "")),
+                              transaction_fields.get(b"MEMO", ""),
+                              transaction_fields.get(b"TRNTYPE", ""))
+                    yield base + consumed, line, record_table, values
+                    transaction_fields = None
+            elif transaction_fields is not None and not closing:
+                transaction_fields[tag] = value.decode("utf-8", "replace")
+        buffer = buffer[consumed:]
+        base += consumed
+        if not chunk:
+            break
+
+@database.tagged("import")
+def import_records(path, username, record_table=None, file_format=None, batch_size=IMPORT_BATCH_SIZE,
+                   rejects_path=None, restart=False, progress=None):
+    path = os.path.abspath(path)
+    if file_format is None:
+        file_format = "ofx" if path.lower().endswith((".ofx", ".qfx")) else "csv"
+    if file_format == "csv" and record_table not in RECORD_LABELS:
+        raise ValueError("CSV imports need record_table 'incomes' or 'expenses'")
+    checkpoint_table = record_table if file_format == "csv" else "ofx"
+
+    if restart:
+        clear_import_checkpoint(path, username, checkpoint_table)
+    offset, line, imported, rejected = get_import_checkpoint(path, username, checkpoint_table) or (0, 0, 0, 0)
+
+    rejects_file = None
+    rejects_writer = None
+    if rejects_path:
+        rejects_file = open(rejects_path, "a" if offset else "w", newline="", encoding="utf-8")
+        rejects_writer = csv.writer(rejects_file)
+        if not offset:
+            rejects_writer.writerow(["line", "error", "amount", "date", "label", "description", "type"])
+
+    # index maintenance dominates bulk inserts, so give SQLite a large page cache while importing
+    with database.writing() as connection:
+        cache_size = connection.execute("PRAGMA cache_size").fetchone()[0]
+        connection.execute(f"PRAGMA cache_size = -{IMPORT_CACHE_SIZE_KB}")
+
+    batches = {"incomes": [], "expenses": []}
+    batch_lines = {"incomes": [], "expenses": []}
+    # (username, category, month) -> the latest overspent alert, so a month reported by many batches shows once
+    alerts = {}
+
+    def flush():
+        nonlocal imported, rejected
+        rejects = []
+        for table, rows in batches.items():
+            errors = validate_records(table, rows)
+            if errors:
+                rejects += [(batch_lines[table][row], "; ".join(message for _, message in field_errors), *rows[row][1:])
+                            for row, field_errors in errors.items()]
+                batches[table] = [record for row, record in enumerate(rows) if row not in errors]
+        if rejects_writer:
+            rejects_writer.writerows(sorted(rejects))
+            rejects_file.flush()
+        saved = len(batches["incomes"]) + len(batches["expenses"])
+        with transaction():
+            save_incomes(batches["incomes"])
+            for alert in save_expenses(batches["expenses"]):
+                alerts[alert[:3]] = alert
+            save_import_checkpoint(path, username, checkpoint_table, offset, line, imported + saved,
+                                   rejected + len(rejects))
+        imported += saved
+        rejected += len(rejects)
+        for table in batches:
+            batches[table] = []
+            batch_lines[table] = []
+        if progress:
+            progress(line, imported, rejected)
+
+    try:
+        with open(path, "rb") as handle:
+            if file_format == "csv":
+                records = iter_csv_records(handle, record_table, offset, line)
+            else:
+                records = iter_ofx_records(handle, offset, line)
+            pending = 0
+            for offset, line, table, values in records:
+                batches[table].append((username, *values))
+                batch_lines[table].append(line)
+                pending += 1
+                if pending >= batch_size:
+                    flush()
+                    pending = 0
+            flush()
+    finally:
+        with database.writing() as connection:
+            connection.execute(f"PRAGMA cache_size = {cache_size}")
+        if rejects_file:
+            rejects_file.close()
+
+    return {"imported": imported, "rejected": rejected, "lines": line, "alerts": list(alerts.values())}
@@ -1,193 +1,221 @@
-import re
-import time
-import datetime
-import sqlite3
+import sys
+import argparse
+import threading
 import tkinter as tk
-from tkinter import messagebox, ttk
-
-conn = sqlite3.connect("finance_manager.db")
-cursor = conn.cursor()
-
-cursor.execute('''CREATE TABLE IF NOT EXISTS users (
-    username TEXT PRIMARY KEY,
-    first_name TEXT,
-    last_name TEXT,
-    phone TEXT,
-    password TEXT,
-    city TEXT,
-    email TEXT,
-    birthdate TEXT,
-    security_question TEXT,
-    security_answer TEXT
-)''')
-
-cursor.execute('''CREATE TABLE IF NOT EXISTS incomes (
-    username TEXT,
-    amount REAL,
-    date TEXT,
-    source TEXT,
-    description TEXT,
-    type TEXT
-)''')
-
-cursor.execute('''CREATE TABLE IF NOT EXISTS expenses (
-    username TEXT,
-    amount REAL,
-    date TEXT,
-    category TEXT,
-    description TEXT,
-    type TEXT
-)''')
-
-cursor.execute('''CREATE TABLE IF NOT EXISTS categories (
-    username TEXT,
-    category TEXT
-)''')
-
-conn.commit()
-
-def execute_query(query, params=()):
-    cursor.execute(query, params)
-    conn.commit()
-
-def fetch_all(query, params=()):
-    cursor.execute(query, params)
-    return cursor.fetchall()
-
-def fetch_one(query, params=()):
-    cursor.execute(query, params)
-    return cursor.fetchone()
-
-def load_users():
-    return {row[0]: row for row in fetch_all("SELECT * FROM users")}
-
-def save_user(user_data):
-    execute_query('''INSERT INTO users (username, first_name, last_name, phone, password, city, email, birthdate, security_question, security_answer)
-                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', user_data)
-
-def load_incomes(username):
-    return fetch_all("SELECT * FROM incomes WHERE username=?", (username,))
-
-def save_income(income_data):
-    execute_query('''INSERT INTO incomes (username, amount, date, source, description, type)
-                     VALUES (?, ?, ?, ?, ?, ?)''', income_data)
-
-def load_expenses(username):
-    return fetch_all("SELECT * FROM expenses WHERE username=?", (username,))
-
-def save_expense(expense_data):
-    execute_query('''INSERT INTO expenses (username, amount, date, category, description, type)
-                     VALUES (?, ?, ?, ?, ?, ?)''', expense_data)
-
-def load_categories(username):
-    return [row[0] for row in fetch_all("SELECT category FROM categories WHERE username=?", (username,))]
-
-def save_category(category_data):
-    execute_query('''INSERT INTO categories (username, category)
-                     VALUES (?, ?)''', category_data)
-
-def is_valid_name(name):
-    return name.isalpha()
-
-def is_valid_phone(phone):
-    return phone.isdigit() and phone.startswith("09") and len(phone) == 11
-
-def is_valid_password(password):
-    if len(password) < 6:
-        return False
-    if not re.search("[a-z]", password):
-        return False
-    if not re.search("[A-Z]", password):
-        return False
-    if not re.search("[0-9]", password):
-        return False
-    if not re.search("[!@#$%^&*()_+]", password):
-        return False
-    return True
-
-def is_valid_email(email):
-    return re.match(r"^[a-zA-Z0-9]+@(gmail|yahoo)\.com$", email) is not None
-
-def is_valid_birthdate(date_text):
-    try:
-        date = datetime.datetime.strptime(date_text, '%Y-%m-%d')
-        return 1920 <= date.year <= 2005
-    except ValueError:
-        return False
+from concurrent.futures import ThreadPoolExecutor
+from tkinter import filedialog, messagebox, ttk
+
+import database
+from database import transaction
+from ledger import (DEFAULT_CURRENCY, DELETE_BATCH_SIZE, EXPORT_CHUNK_SIZE, EXPORT_FORMATS, IMPORT_BATCH_SIZE,
+                    PAGE_COLUMNS, RECORD_LABELS, RECURRENCE_FREQUENCIES, REPORT_GROUPS, REPORT_PERIODS,
+                    RESULTS_PAGE_SIZE, authenticate, budget_status, build_report_query, build_search_query,
+                    configure_analytics_cache, delete_user, export_query, fetch_cached_page, format_amount,
+                    get_report_range, grouped_report, import_records, is_valid_birthdate, is_valid_email,
+                    is_valid_password, load_categories, rebuild_balance_checkpoints, rebuild_rollups, remove_budget,
+                    rename_category, report_total, save_category, save_expense, save_income, save_recurring_rule,
+                    save_user, set_budget, sweep_orphans, update_user_field, user_exists, validate_record,
+                    validate_users)
+
+QUERY_WORKERS = 2
+QUERY_POLL_MS = 20
+PROGRESS_POLL_MS = 200
+SEARCH_DEBOUNCE_MS = 300
+
+_query_executor = None
+
+def get_query_executor():
+    global _query_executor
+    if _query_executor is None:
+        _query_executor = ThreadPoolExecutor(max_workers=QUERY_WORKERS, thread_name_prefix="query")
+    return _query_executor
+
+def run_in_background(widget, func, *args, on_done=None, on_error=None, tag=None):
+    # runs func on a query worker and hands the result back to the Tk thread via widget.after;
+    # the returned cancel() drops the result and interrupts the query if it is still running.
+    # tag names the dialog in the query metrics of the statements func runs
+    lock = threading.Lock()
+    task = {"cancelled": False, "thread": None}
+
+    def work():
+        with lock:
+            if task["cancelled"]:
+                return None
+            task["thread"] = threading.get_ident()
+        try:
+            if tag is None:
+                return func(*args)
+            with database.tagged(tag):
+                return func(*args)
+        finally:
+            with lock:
+                task["thread"] = None
+
+    def cancel():
+        with lock:
+            task["cancelled"] = True
+            future.cancel()
+            if task["thread"] is not None:
+                database.interrupt(task["thread"])
+
+    def poll():
+        if task["cancelled"]:
+            return
+        if not future.done():
+            widget.after(QUERY_POLL_MS, poll)
+            return
+        try:
+            result = future.result()
+        except Exception as error:
+            if on_error:
+                on_error(error)
+            else:
+                messagebox.showerror("Error", str(error))
+            return
+        if on_done:
+            on_done(result)
 
-def is_valid_amount(amount):
-    try:
-        float_amount = float(amount)
-        return float_amount > 0
-    except ValueError:
-        return False
-    
-def is_valid_date(date_text):
-    try:
-        datetime.datetime.strptime(date_text, '%Y-%m-%d')
-        return True
-    except ValueError:
-        return False
+    future = get_query_executor().submit(work)
+    widget.after(QUERY_POLL_MS, poll)
+    return cancel
 
-def get_cities():
-    return ["Tehran", "Mashhad", "Isfahan", "Karaj", "Tabriz", "Shiraz", "Qom", "Ahvaz", "Kermanshah", "Urmia"]
+def cancel_on_destroy(window, cancel):
+    window.bind("<Destroy>", lambda event: cancel() if event.widget is window else None, add="+")
 
-def signup():
-    def handle_signup():
-        users = load_users()
+RESULTS_WINDOW_PAGES = 3
 
-        first_name = first_name_entry.get()
-        if not is_valid_name(first_name):
-            messagebox.showerror("Error", "Invalid first name. Use English letters only.")
-            return
+def record_values(row):
+    # (id, date, username, amount, date, label, description, type, currency, ...) as selected by PAGE_COLUMNS
+    return (row[2], f"{format_amount(row[3])} {row[8]}", *row[4:8])
 
-        last_name = last_name_entry.get()
-        if not is_valid_name(last_name):
-            messagebox.showerror("Error", "Invalid last name. Use English letters only.")
-            return
+def attach_paged_results(results_tree, scrollbar, tag, username, page_size=RESULTS_PAGE_SIZE,
+                         window_pages=RESULTS_WINDOW_PAGES):
+    # only window_pages pages exist as Tk items; the rest is fetched again when scrolled back into view.
+    # load(build, *args) builds the query and fetches pages on a query worker, and a new load() supersedes any
+    # page still in flight. Pages come from the ledger's page cache until username's records change
+    state = {"query": None, "params": None, "pages": [], "at_start": True, "at_end": True, "cancel": None}
 
-        phone = phone_entry.get()
-        if not is_valid_phone(phone):
-            messagebox.showerror("Error", "Invalid phone number. Must start with 09 and be 11 digits long.")
-            return
+    def page_key(row):
+        return row[1], row[0]
 
-        username = username_entry.get()
-        if username in users:
-            messagebox.showerror("Error", "Username already exists.")
-            return
+    def item_id(row):
+        # recurring occurrences share their rule's id, so the date is part of the Tk item id
+        return f"{row[1]}:{row[0]}"
 
-        password = password_entry.get()
-        if not is_valid_password(password):
-            messagebox.showerror("Error", "Invalid password. Must contain at least one lowercase letter, one uppercase letter, one digit, one symbol, and be at least 6 characters long.")
-            return
+    def fetch(on_done, after=None, before=None):
+        state["cancel"] = run_in_background(results_tree, fetch_cached_page, username, state["query"], state["params"],
+                                            after, before, page_size, on_done=on_done, tag=tag)
 
-        confirm_password = confirm_password_entry.get()
-        if password != confirm_password:
-            messagebox.showerror("Error", "Passwords do not match.")
-            return
+    def cancel():
+        if state["cancel"]:
+            state["cancel"]()
+            state["cancel"] = None
 
-        city = city_entry.get()
-        if city not in get_cities():
-            messagebox.showerror("Error", "Invalid city.")
+    def load(build, *args, on_error=None):
+        cancel()
+        results_tree.delete(*results_tree.get_children())
+        state.update(query=None, params=None, pages=[], at_start=True, at_end=False)
+        state["cancel"] = run_in_background(results_tree, first_page, build, args, on_done=show_first,
+                                            on_error=on_error, tag=tag)
+
+    def first_page(build, args):
+        # building may read the recurring rules, so it stays off the Tk thread with the fetch
+        query, params = build(*args, columns=PAGE_COLUMNS)
+        return query, params, fetch_cached_page(username, query, params, None, None, page_size)
+
+    def show_first(result):
+        query, params, rows = result
+        state.update(query=query, params=params)
+        show_next(rows)
+
+    def load_next():
+        pages = state["pages"]
+        fetch(show_next, after=pages[-1][1] if pages else None)
+
+    def show_next(rows):
+        state["cancel"] = None
+        pages = state["pages"]
+        state["at_end"] = len(rows) < page_size
+        if not rows:
             return
-
-        email = email_entry.get()
-        if not is_valid_email(email):
-            messagebox.showerror("Error", "Invalid email.")
+        items = [results_tree.insert("", tk.END, iid=item_id(row), values=record_values(row)) for row in rows]
+        pages.append((page_key(rows[0]), page_key(rows[-1]), items))
+        if len(pages) > window_pages:
+            results_tree.delete(*pages.pop(0)[2])
+            state["at_start"] = False
+        results_tree.see(items[0])
+
+    def load_previous():
+        fetch(show_previous, before=state["pages"][0][0])
+
+    def show_previous(rows):
+        state["cancel"] = None
+        pages = state["pages"]
+        state["at_start"] = len(rows) < page_size
+        if not rows:
             return
+        items = [results_tree.insert("", index, iid=item_id(row), values=record_values(row))
+                 for index, row in enumerate(rows)]
+        pages.insert(0, (page_key(rows[0]), page_key(rows[-1]), items))
+        if len(pages) > window_pages:
+            results_tree.delete(*pages.pop()[2])
+            state["at_end"] = False
+        results_tree.see(items[-1])
+
+    def on_scroll(first, last):
+        scrollbar.set(first, last)
+        if state["query"] is None or state["cancel"] is not None:
+            return
+        if float(last) >= 1.0 and not state["at_end"]:
+            load_next()
+        elif float(first) <= 0.0 and not state["at_start"]:
+            load_previous()
+
+    results_tree.configure(yscrollcommand=on_scroll)
+    scrollbar.configure(command=results_tree.yview)
+    cancel_on_destroy(results_tree.winfo_toplevel(), cancel)
+    return load
+
+def ask_export(window, build, args):
+    if args is None:
+        messagebox.showerror("Error", "Run a query before exporting.")
+        return
+    path = filedialog.asksaveasfilename(defaultextension=".csv",
+                                        filetypes=[("CSV", "*.csv"), ("Parquet", "*.parquet")])
+    if not path:
+        return
+
+    def export():
+        query, params = build(*args)
+        return export_query(query, params, path)
+
+    # a full export can take a while, so it is built and streamed on a worker like the paged queries
+    cancel = run_in_background(window, export, tag="export",
+                               on_done=lambda exported: messagebox.showinfo("Success", f"Exported {exported} records."))
+    cancel_on_destroy(window, cancel)
 
-        birthdate = birthdate_entry.get()
-        if not is_valid_birthdate(birthdate):
-            messagebox.showerror("Error", "Invalid birthdate.")
+def signup():
+    def handle_signup():
+        username = username_entry.get()
+        password = password_entry.get()
+        user_data = (username, first_name_entry.get(), last_name_entry.get(), phone_entry.get(), password,
+                     city_entry.get(), email_entry.get(), birthdate_entry.get(), security_question_entry.get(),
+                     security_answer_entry.get())
+
+        # report every problem at once instead of one message box per field
+        messages = [message for _, message in validate_users([user_data]).get(0, [])]
+        if password != confirm_password_entry.get():
+            messages.append("Passwords do not match.")
+        if messages:
+            messagebox.showerror("Error", "\n".join(messages))
             return
 
-        security_question = security_question_entry.get()
-        security_answer = security_answer_entry.get()
+        def registered(result):
+            messagebox.showinfo("Success", "Registration successful. You can now log in.")
+            signup_window.destroy()
 
-        user_data = (username, first_name, last_name, phone, password, city, email, birthdate, security_question, security_answer)
-        save_user(user_data)
-        messagebox.showinfo("Success", "Registration successful. You can now log in.")
-        signup_window.destroy()
+        # hashing the password and security answer takes a noticeable moment, so keep it off the Tk thread
+        run_in_background(signup_window, save_user, user_data, on_done=registered)
 
     signup_window = tk.Toplevel()
     signup_window.title("Sign Up")
@@ -240,16 +268,18 @@ def signup():
 
 def login():
     def handle_login():
-        users = load_users()
         username = username_entry.get()
         password = password_entry.get()
 
-        if username in users and users[username][4] == password:
-            messagebox.showinfo("Success", "Login successful.")
-            login_window.destroy()
-            user_menu(username)
-        else:
-            messagebox.showerror("Error", "Invalid username or password.")
+        def authenticated(user):
+            if user is not None:
+                messagebox.showinfo("Success", "Login successful.")
+                login_window.destroy()
+                user_menu(username)
+            else:
+                messagebox.showerror("Error", "Invalid username or password.")
+
+        run_in_background(login_window, authenticate, username, password, on_done=authenticated)
 
     login_window = tk.Toplevel()
     login_window.title("Log In")
@@ -272,18 +302,24 @@ def add_income(username):
         description = description_entry.get()
         type_ = type_entry.get()
 
-        if not is_valid_amount(amount):
-            messagebox.showerror("Error", "Invalid amount.")
+        income_data = (username, amount, date, source, description, type_)
+        errors = validate_record("incomes", income_data)
+        if errors:
+            messagebox.showerror("Error", "\n".join(message for _, message in errors))
             return
 
-        if not is_valid_date(date):
-            messagebox.showerror("Error", "Invalid date format. Use YYYY-MM-DD.")
-            return
+        def saved(result):
+            messagebox.showinfo("Success", f"{'Recurring income' if repeating else 'Income'} added successfully.")
+            add_income_window.destroy()
 
-        income_data = (username, amount, date, source, description, type_)
-        save_income(income_data)
-        messagebox.showinfo("Success", "Income added successfully.")
-        add_income_window.destroy()
+        # a save also updates the search index, rollups and checkpoints, and may wait on another writer's lock
+        repeating = repeat_var.get() != "never"
+        if repeating:
+            # a rule instead of a record; searches and reports expand it into the dates they cover
+            run_in_background(add_income_window, save_recurring_rule, "incomes", income_data, repeat_var.get(),
+                              until_entry.get(), on_done=saved)
+        else:
+            run_in_background(add_income_window, save_income, income_data, on_done=saved)
 
     add_income_window = tk.Toplevel()
     add_income_window.title("Add Income")
@@ -308,7 +344,16 @@ def add_income(username):
     type_entry = tk.Entry(add_income_window)
     type_entry.grid(row=4, column=1)
 
-    tk.Button(add_income_window, text="Add Income", command=handle_add_income).grid(row=5, column=0, columnspan=2)
+    tk.Label(add_income_window, text="Repeat").grid(row=5, column=0)
+    repeat_var = tk.StringVar(value="never")
+    ttk.Combobox(add_income_window, textvariable=repeat_var, values=["never", *RECURRENCE_FREQUENCIES],
+                 state="readonly").grid(row=5, column=1)
+
+    tk.Label(add_income_window, text="Until (YYYY-MM-DD, optional)").grid(row=6, column=0)
+    until_entry = tk.Entry(add_income_window)
+    until_entry.grid(row=6, column=1)
+
+    tk.Button(add_income_window, text="Add Income", command=handle_add_income).grid(row=7, column=0, columnspan=2)
 
 def add_expense(username):
     def handle_add_expense():
@@ -318,18 +363,28 @@ def add_expense(username):
         description = description_entry.get()
         type_ = type_entry.get()
 
-        if not is_valid_amount(amount):
-            messagebox.showerror("Error", "Invalid amount.")
-            return
-
-        if not is_valid_date(date):
-            messagebox.showerror("Error", "Invalid date format. Use YYYY-MM-DD.")
+        expense_data = (username, amount, date, category, description, type_)
+        errors = validate_record("expenses", expense_data)
+        if errors:
+            messagebox.showerror("Error", "\n".join(message for _, message in errors))
             return
 
-        expense_data = (username, amount, date, category, description, type_)
-        save_expense(expense_data)
-        messagebox.showinfo("Success", "Expense added successfully.")
-        add_expense_window.destroy()
+        def saved(alerts):
+            messagebox.showinfo("Success", f"{'Recurring expense' if repeating else 'Expense'} added successfully.")
+            if alerts:
+                messagebox.showwarning("Over Budget", "\n".join(
+                    f"{category} in {month}: {spent} spent of a {budget} {DEFAULT_CURRENCY} budget"
+                    for _, category, month, spent, budget in alerts))
+            add_expense_window.destroy()
+
+        # a save also updates the search index, rollups, checkpoints and budgets, and may wait on another writer's lock
+        repeating = repeat_var.get() != "never"
+        if repeating:
+            # a rule instead of a record; searches and reports expand it into the dates they cover
+            run_in_background(add_expense_window, save_recurring_rule, "expenses", expense_data, repeat_var.get(),
+                              until_entry.get(), on_done=lambda rule_id: saved([]))
+        else:
+            run_in_background(add_expense_window, save_expense, expense_data, on_done=saved)
 
     add_expense_window = tk.Toplevel()
     add_expense_window.title("Add Expense")
@@ -354,15 +409,35 @@ def add_expense(username):
     type_entry = tk.Entry(add_expense_window)
     type_entry.grid(row=4, column=1)
 
-    tk.Button(add_expense_window, text="Add Expense", command=handle_add_expense).grid(row=5, column=0, columnspan=2)
+    tk.Label(add_expense_window, text="Repeat").grid(row=5, column=0)
+    repeat_var = tk.StringVar(value="never")
+    ttk.Combobox(add_expense_window, textvariable=repeat_var, values=["never", *RECURRENCE_FREQUENCIES],
+                 state="readonly").grid(row=5, column=1)
+
+    tk.Label(add_expense_window, text="Until (YYYY-MM-DD, optional)").grid(row=6, column=0)
+    until_entry = tk.Entry(add_expense_window)
+    until_entry.grid(row=6, column=1)
+
+    tk.Button(add_expense_window, text="Add Expense", command=handle_add_expense).grid(row=7, column=0, columnspan=2)
 
 def add_category(username):
     def handle_add_category():
         category = category_entry.get()
         category_data = (username, category)
-        save_category(category_data)
-        messagebox.showinfo("Success", "Category added successfully.")
-        add_category_window.destroy()
+
+        def saved(result):
+            messagebox.showinfo("Success", "Category added successfully.")
+            add_category_window.destroy()
+
+        run_in_background(add_category_window, save_category, category_data, on_done=saved)
+
+    def handle_rename_category():
+        def renamed(result):
+            messagebox.showinfo("Success", "Category renamed successfully.")
+            add_category_window.destroy()
+
+        run_in_background(add_category_window, rename_category, username, rename_from_var.get(),
+                          rename_to_entry.get(), on_done=renamed)
 
     add_category_window = tk.Toplevel()
     add_category_window.title("Add Category")
@@ -373,8 +448,64 @@ def add_category(username):
 
     tk.Button(add_category_window, text="Add Category", command=handle_add_category).grid(row=1, column=0, columnspan=2)
 
+    tk.Label(add_category_window, text="Rename").grid(row=2, column=0)
+    rename_from_var = tk.StringVar()
+    rename_from_box = ttk.Combobox(add_category_window, textvariable=rename_from_var, state="readonly")
+    rename_from_box.grid(row=2, column=1)
+    run_in_background(add_category_window, load_categories, username,
+                      on_done=lambda names: rename_from_box.configure(values=names))
+
+    tk.Label(add_category_window, text="New Name").grid(row=3, column=0)
+    rename_to_entry = tk.Entry(add_category_window)
+    rename_to_entry.grid(row=3, column=1)
+
+    tk.Button(add_category_window, text="Rename Category", command=handle_rename_category).grid(row=4, column=0, columnspan=2)
+
+def manage_budgets(username):
+    def handle_set_budget():
+        run_in_background(budgets_window, set_budget, username, category_var.get(), amount_entry.get(),
+                          on_done=lambda result: load_status())
+
+    def handle_remove_budget():
+        run_in_background(budgets_window, remove_budget, username, category_var.get(),
+                          on_done=lambda result: load_status())
+
+    def load_status():
+        run_in_background(budgets_window, budget_status, username, on_done=show_status)
+
+    def show_status(status):
+        status_tree.delete(*status_tree.get_children())
+        for row in status:
+            status_tree.insert("", tk.END, values=row)
+
+    budgets_window = tk.Toplevel()
+    budgets_window.title("Monthly Budgets")
+
+    tk.Label(budgets_window, text="Category").grid(row=0, column=0)
+    category_var = tk.StringVar()
+    category_box = ttk.Combobox(budgets_window, textvariable=category_var)
+    category_box.grid(row=0, column=1)
+    run_in_background(budgets_window, load_categories, username,
+                      on_done=lambda names: category_box.configure(values=names))
+
+    tk.Label(budgets_window, text="Monthly Amount").grid(row=1, column=0)
+    amount_entry = tk.Entry(budgets_window)
+    amount_entry.grid(row=1, column=1)
+
+    tk.Button(budgets_window, text="Set Budget", command=handle_set_budget).grid(row=2, column=0)
+    tk.Button(budgets_window, text="Remove Budget", command=handle_remove_budget).grid(row=2, column=1)
+
+    # this month's spend per budgeted category, recurring expenses included
+    status_tree = ttk.Treeview(budgets_window, columns=("category", "budget", "spent", "remaining"), show='headings')
+    for col in ("category", "budget", "spent", "remaining"):
+        status_tree.heading(col, text=col.capitalize())
+    status_tree.grid(row=3, column=0, columnspan=2)
+    load_status()
+
 def search_records(username):
-    def handle_search():
+    def handle_search(live=False):
+        # live searches come from typing: half-typed dates and amounts are skipped instead of reported
+        cancel_pending()
         term = search_term_entry.get()
         start_date = start_date_entry.get()
         end_date = end_date_entry.get()
@@ -383,32 +514,32 @@ def search_records(username):
         max_amount = max_amount_entry.get()
         fields = [field for field, var in search_fields.items() if var.get()]
 
-        query = "SELECT * FROM {} WHERE username=?".format(record_type)
-
-        params = [username]
-        if term:
-            term_conditions = " OR ".join([f"{field} LIKE ?" for field in fields])
-            query += f" AND ({term_conditions})"
-            params += [f"%{term}%"] * len(fields)
-        if start_date:
-            query += " AND date >= ?"
-            params.append(start_date)
-        if end_date:
-            query += " AND date <= ?"
-            params.append(end_date)
-        if min_amount:
-            query += " AND amount >= ?"
-            params.append(min_amount)
-        if max_amount:
-            query += " AND amount <= ?"
-            params.append(max_amount)
-
-        records = fetch_all(query, params)
-        for record in records:
-            results_tree.insert("", tk.END, values=record)
+        args = (username, record_type, term, fields, start_date, end_date, min_amount, max_amount)
+        if live and last_args[0] == args:
+            return
+        last_args[0] = args
+        load_results(build_search_query, *args, on_error=lambda error: show_search_error(error, live))
+
+    def show_search_error(error, live):
+        if not (live and isinstance(error, ValueError)):
+            messagebox.showerror("Error", str(error))
+
+    def schedule_search(*_):
+        # every keystroke restarts the timer, so only a pause in typing runs a query
+        cancel_pending()
+        pending[0] = search_window.after(SEARCH_DEBOUNCE_MS, lambda: handle_search(live=True))
+
+    def cancel_pending():
+        if pending[0] is not None:
+            search_window.after_cancel(pending[0])
+            pending[0] = None
+
+    last_args = [None]
+    pending = [None]
 
     search_window = tk.Toplevel()
     search_window.title("Search Records")
+    cancel_on_destroy(search_window, cancel_pending)
 
     tk.Label(search_window, text="Search Term").grid(row=0, column=0)
     search_term_entry = tk.Entry(search_window)
@@ -446,12 +577,22 @@ def search_records(username):
     for i, (field, var) in enumerate(search_fields.items()):
         tk.Checkbutton(search_window, text=field.capitalize(), variable=var).grid(row=6+i, column=1)
 
-    tk.Button(search_window, text="Search", command=handle_search).grid(row=11, column=0, columnspan=2)
+    for entry in (search_term_entry, start_date_entry, end_date_entry, min_amount_entry, max_amount_entry):
+        entry.bind("<KeyRelease>", schedule_search)
+    for var in (record_type_var, *search_fields.values()):
+        var.trace_add("write", schedule_search)
+
+    tk.Button(search_window, text="Search", command=handle_search).grid(row=11, column=0)
+    tk.Button(search_window, text="Export",
+              command=lambda: ask_export(search_window, build_search_query, last_args[0])).grid(row=11, column=1)
 
     results_tree = ttk.Treeview(search_window, columns=("username", "amount", "date", "source", "description", "type"), show='headings')
     for col in ("username", "amount", "date", "source", "description", "type"):
         results_tree.heading(col, text=col.capitalize())
     results_tree.grid(row=12, column=0, columnspan=2)
+    results_scrollbar = ttk.Scrollbar(search_window, orient=tk.VERTICAL)
+    results_scrollbar.grid(row=12, column=2, sticky="ns")
+    load_results = attach_paged_results(results_tree, results_scrollbar, "search", username)
 
 def generate_report(username):
     def handle_generate_report():
@@ -459,43 +600,24 @@ def generate_report(username):
         filter_type = filter_type_var.get()
         start_date = start_date_entry.get()
         end_date = end_date_entry.get()
+        last_args[0] = (username, record_type, filter_type, start_date, end_date)
 
-        query = f"SELECT * FROM {record_type} WHERE username=?"
-        params = [username]
-
-        if filter_type == "day":
-            today = datetime.datetime.now().date()
-            query += " AND date = ?"
-            params.append(today)
-        elif filter_type == "month":
-            month_start = datetime.datetime.now().replace(day=1).date()
-            next_month = datetime.datetime.now().replace(day=28) + datetime.timedelta(days=4)
-            month_end = next_month.replace(day=1) - datetime.timedelta(days=1)
-            query += " AND date BETWEEN ? AND ?"
-            params.extend([month_start, month_end])
-        elif filter_type == "year":
-            year_start = datetime.datetime.now().replace(month=1, day=1).date()
-            year_end = datetime.datetime.now().replace(month=12, day=31).date()
-            query += " AND date BETWEEN ? AND ?"
-            params.extend([year_start, year_end])
-        elif filter_type == "custom":
-            if not is_valid_date(start_date) or not is_valid_date(end_date):
-                messagebox.showerror("Error", "Invalid date format. Use YYYY-MM-DD.")
-                return
-            query += " AND date BETWEEN ? AND ?"
-            params.extend([start_date, end_date])
-
-        records = fetch_all(query, params)
-        total_amount = sum(record[1] for record in records)
+        if total_task[0]:
+            total_task[0]()
+        total_label.config(text="Total: ...")
+        # a bad range fails both tasks the same way; the page load is the one that reports it
+        total_task[0] = run_in_background(report_window, report_total, username, record_type, filter_type,
+                                          start_date, end_date,
+                                          on_done=lambda total: total_label.config(text=f"Total: {total} {DEFAULT_CURRENCY}"),
+                                          on_error=lambda error: total_label.config(text="Total: "))
+        load_results(build_report_query, *last_args[0])
 
-        results_tree.delete(*results_tree.get_children())
-        for record in records:
-            results_tree.insert("", tk.END, values=record)
-
-        total_label.config(text=f"Total: {total_amount}")
+    last_args = [None]
+    total_task = [None]
 
     report_window = tk.Toplevel()
     report_window.title("Generate Report")
+    cancel_on_destroy(report_window, lambda: total_task[0] and total_task[0]())
 
     tk.Label(report_window, text="Record Type").grid(row=0, column=0)
     record_type_var = tk.StringVar(value="incomes")
@@ -517,12 +639,17 @@ def generate_report(username):
     end_date_entry = tk.Entry(report_window)
     end_date_entry.grid(row=2, column=3)
 
-    tk.Button(report_window, text="Generate Report", command=handle_generate_report).grid(row=3, column=0, columnspan=4)
+    tk.Button(report_window, text="Generate Report", command=handle_generate_report).grid(row=3, column=0, columnspan=2)
+    tk.Button(report_window, text="Export",
+              command=lambda: ask_export(report_window, build_report_query, last_args[0])).grid(row=3, column=2, columnspan=2)
 
     results_tree = ttk.Treeview(report_window, columns=("username", "amount", "date", "category", "description"), show='headings')
     for col in ("username", "amount", "date", "category", "description"):
         results_tree.heading(col, text=col.capitalize())
     results_tree.grid(row=4, column=0, columnspan=4)
+    results_scrollbar = ttk.Scrollbar(report_window, orient=tk.VERTICAL)
+    results_scrollbar.grid(row=4, column=4, sticky="ns")
+    load_results = attach_paged_results(results_tree, results_scrollbar, "report", username)
 
     total_label = tk.Label(report_window, text="Total: ")
     total_label.grid(row=5, column=0, columnspan=4)
@@ -530,22 +657,49 @@ def generate_report(username):
 
 def show_report_window(username, report_type):
     def handle_generate_report():
-        start_date = start_date_entry.get()
-        end_date = end_date_entry.get()
-        min_amount = min_amount_entry.get()
-        max_amount = max_amount_entry.get()
-        
-        records, total_amount, proportion, overall_total = generate_report(
-            username, report_type, start_date, end_date, min_amount, max_amount
-        )
-        
-        for record in records:
-            results_tree.insert("", tk.END, values=record)
-        
-        summary_label.config(text=f"Total: {total_amount}, Proportion: {proportion:.2f}%, Overall Total: {overall_total}")
+        try:
+            start, end = get_report_range("custom", start_date_entry.get(), end_date_entry.get())
+        except ValueError as error:
+            messagebox.showerror("Error", str(error))
+            return
+        if report_task[0]:
+            report_task[0]()
+        summary_label.config(text="Total: ...")
+        report_task[0] = run_in_background(report_window, grouped_report, username, start, end, period_var.get(),
+                                           group_var.get(), min_amount_entry.get(), max_amount_entry.get(),
+                                           on_done=show_report, on_error=show_error)
+
+    def show_error(error):
+        summary_label.config(text="")
+        messagebox.showerror("Error", str(error))
+
+    def show_report(report):
+        # one column per period, filled from the same pass as the summary below
+        columns = ["table", "group"] + report["periods"] + ["total", "share"]
+        results_tree.delete(*results_tree.get_children())
+        results_tree.config(columns=columns)
+        for col in columns:
+            results_tree.heading(col, text=col.capitalize() if col in ("table", "group", "total", "share") else col)
+            results_tree.column(col, width=90)
+        for line in report["lines"]:
+            share = "" if line["share"] is None else f"{line['share']}%"
+            results_tree.insert("", tk.END, values=(line["record_table"], line["group"] or "All", *line["values"],
+                                                    line["total"], share))
+        results_tree.insert("", tk.END, values=("net", "", *report["net"], report["balance"], ""))
+        results_tree.insert("", tk.END, values=("balance", "", *report["balances"], "", ""))
+
+        proportion = report["proportions"][report_type]
+        proportion = "-" if proportion is None else f"{proportion}%"
+        summary_label.config(text=f"Total: {report['totals'][report_type]} {DEFAULT_CURRENCY}, "
+                                  f"Proportion: {proportion}, "
+                                  f"Overall Total: {report['overall_totals'][report_type]} {DEFAULT_CURRENCY}, "
+                                  f"Net Balance: {report['balance']} {DEFAULT_CURRENCY}")
+
+    report_task = [None]
 
     report_window = tk.Toplevel()
     report_window.title(f"{report_type.capitalize()} Report")
+    cancel_on_destroy(report_window, lambda: report_task[0] and report_task[0]())
 
     tk.Label(report_window, text="Start Date (YYYY-MM-DD)").grid(row=0, column=0)
     start_date_entry = tk.Entry(report_window)
@@ -563,15 +717,26 @@ def show_report_window(username, report_type):
     max_amount_entry = tk.Entry(report_window)
     max_amount_entry.grid(row=3, column=1)
 
-    tk.Button(report_window, text="Generate Report", command=handle_generate_report).grid(row=4, column=0, columnspan=2)
+    tk.Label(report_window, text="Period").grid(row=4, column=0)
+    period_var = tk.StringVar(value="month")
+    ttk.Combobox(report_window, textvariable=period_var, values=list(REPORT_PERIODS), state="readonly").grid(row=4, column=1)
 
-    results_tree = ttk.Treeview(report_window, columns=("username", "amount", "date", "source", "description", "type"), show='headings')
-    for col in ("username", "amount", "date", "source", "description", "type"):
+    tk.Label(report_window, text="Group By").grid(row=5, column=0)
+    group_var = tk.StringVar(value="label")
+    ttk.Combobox(report_window, textvariable=group_var, values=list(REPORT_GROUPS), state="readonly").grid(row=5, column=1)
+
+    tk.Button(report_window, text="Generate Report", command=handle_generate_report).grid(row=6, column=0, columnspan=2)
+
+    results_tree = ttk.Treeview(report_window, columns=("table", "group", "total", "share"), show='headings')
+    for col in ("table", "group", "total", "share"):
         results_tree.heading(col, text=col.capitalize())
-    results_tree.grid(row=5, column=0, columnspan=2)
+    results_tree.grid(row=7, column=0, columnspan=2)
+    results_scrollbar = ttk.Scrollbar(report_window, orient=tk.HORIZONTAL, command=results_tree.xview)
+    results_tree.configure(xscrollcommand=results_scrollbar.set)
+    results_scrollbar.grid(row=8, column=0, columnspan=2, sticky="ew")
 
     summary_label = tk.Label(report_window, text="")
-    summary_label.grid(row=6, column=0, columnspan=2)
+    summary_label.grid(row=9, column=0, columnspan=2)
 
 def user_settings(username):
     def handle_update_settings():
@@ -588,17 +753,41 @@ def user_settings(username):
             messagebox.showerror("Error", "Invalid birthdate format.")
             return
 
-        query = f"UPDATE users SET {update_field} = ? WHERE username = ?"
-        execute_query(query, (new_value, username))
-        messagebox.showinfo("Success", "User information updated successfully.")
-        settings_window.destroy()
+        def updated(result):
+            messagebox.showinfo("Success", "User information updated successfully.")
+            settings_window.destroy()
+
+        run_in_background(settings_window, update_user_field, username, update_field, new_value, on_done=updated)
 
     def handle_delete_user():
-        if messagebox.askyesno("Confirm", "Are you sure you want to delete this user?"):
-            execute_query("DELETE FROM users WHERE username = ?", (username,))
+        # the worker only records its progress; the Tk thread polls it, like run_in_background polls the result
+        progress = {"deleted": 0, "total": 0, "done": False}
+
+        def record_progress(deleted, total):
+            progress.update(deleted=deleted, total=total)
+
+        def show_progress():
+            if progress["done"]:
+                return
+            status_label.config(text=f"Deleting records: {progress['deleted']} of {progress['total']}")
+            settings_window.after(PROGRESS_POLL_MS, show_progress)
+
+        def deleted(result):
+            progress["done"] = True
             messagebox.showinfo("Success", "User deleted successfully.")
             settings_window.destroy()
 
+        def failed(error):
+            progress["done"] = True
+            status_label.config(text="")
+            messagebox.showerror("Error", str(error))
+
+        if messagebox.askyesno("Confirm", "Are you sure you want to delete this user?"):
+            delete_button.config(state=tk.DISABLED)
+            run_in_background(settings_window, delete_user, username, DELETE_BATCH_SIZE, record_progress,
+                              on_done=deleted, on_error=failed)
+            show_progress()
+
     settings_window = tk.Toplevel()
     settings_window.title("User Settings")
 
@@ -615,7 +804,10 @@ def user_settings(username):
     new_value_entry.grid(row=1, column=1, columnspan=4)
 
     tk.Button(settings_window, text="Update Settings", command=handle_update_settings).grid(row=2, column=0, columnspan=5)
-    tk.Button(settings_window, text="Delete User", command=handle_delete_user).grid(row=3, column=0, columnspan=5)
+    delete_button = tk.Button(settings_window, text="Delete User", command=handle_delete_user)
+    delete_button.grid(row=3, column=0, columnspan=5)
+    status_label = tk.Label(settings_window, text="")
+    status_label.grid(row=4, column=0, columnspan=5)
 
 
 def user_menu(username):
@@ -627,12 +819,113 @@ def user_menu(username):
     tk.Button(user_window, text="Add Category", command=lambda: add_category(username)).grid(row=1, column=0)
     tk.Button(user_window, text="Search Records", command=lambda: search_records(username)).grid(row=1, column=1)
     tk.Button(user_window, text="Generate Report", command=lambda: generate_report(username)).grid(row=2, column=0, columnspan=2)
-    tk.Button(user_window, text="Settings", command=lambda: user_settings(username)).grid(row=3, column=0, columnspan=2)
+    tk.Button(user_window, text="Income Trends", command=lambda: show_report_window(username, "incomes")).grid(row=3, column=0)
+    tk.Button(user_window, text="Expense Trends", command=lambda: show_report_window(username, "expenses")).grid(row=3, column=1)
+    tk.Button(user_window, text="Budgets", command=lambda: manage_budgets(username)).grid(row=4, column=0)
+    tk.Button(user_window, text="Settings", command=lambda: user_settings(username)).grid(row=4, column=1)
 
-root = tk.Tk()
-root.title("Expense Tracker")
+def run_gui(args):
+    root = tk.Tk()
+    root.title("Expense Tracker")
 
-tk.Button(root, text="Register", command=signup).grid(row=0, column=0)
-tk.Button(root, text="Log In", command=login).grid(row=0, column=1)
+    tk.Button(root, text="Register", command=signup).grid(row=0, column=0)
+    tk.Button(root, text="Log In", command=login).grid(row=0, column=1)
+
+    root.mainloop()
+
+def run_import(args):
+    if not user_exists(args.username):
+        sys.exit(f"Unknown user: {args.username}")
+
+    def progress(line, imported, rejected):
+        print(f"line {line}: {imported} imported, {rejected} rejected", file=sys.stderr)
+
+    result = import_records(args.path, args.username, args.table, args.format, args.batch_size,
+                            args.rejects, args.restart, progress)
+    print(f"Imported {result['imported']} records, rejected {result['rejected']}.")
+    for _, category, month, spent, budget in result["alerts"]:
+        print(f"Over budget: {category} in {month}, {spent} spent of {budget}.")
+
+def run_rebuild_rollups(args):
+    with transaction() as connection:
+        rebuild_rollups(connection)
+        rebuild_balance_checkpoints(connection)
+    print("Rollups rebuilt.")
+
+def run_sweep_orphans(args):
+    def progress(deleted, total):
+        print(f"{deleted} of {total} orphaned rows deleted", file=sys.stderr)
+
+    result = sweep_orphans(args.batch_size, progress, args.vacuum)
+    print(f"Deleted {result['deleted']} rows left behind by {result['usernames']} deleted users.")
+
+def run_export(args):
+    try:
+        if args.report:
+            query, params = build_report_query(args.username, args.table, args.report, args.start_date, args.end_date)
+        else:
+            fields = args.fields.split(",") if args.fields else ["amount", "date", RECORD_LABELS[args.table], "description", "type"]
+            query, params = build_search_query(args.username, args.table, args.term, fields, args.start_date,
+                                               args.end_date, args.min_amount, args.max_amount)
+        exported = export_query(query, params, args.path, args.format, args.chunk_size)
+    except (RuntimeError, ValueError) as error:
+        sys.exit(str(error))
+    print(f"Exported {exported} records.")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Expense Tracker")
+    parser.add_argument("--slow-query-ms", type=float, default=database.SLOW_QUERY_MS,
+                        help="log statements slower than this, with their query plan (default: %(default)s)")
+    parser.add_argument("--slow-query-log", help="append slow statements to this file as JSON lines")
+    parser.add_argument("--analytics-cache-mb", type=float, default=0,
+                        help="keep whole ledgers of recently reported users in memory, up to this size (default: off)")
+    parser.add_argument("--metrics", help="write per-query timings and latency histograms to this JSON file on exit")
+    subparsers = parser.add_subparsers(dest="command")
+    parser.set_defaults(func=run_gui)
+
+    importer = subparsers.add_parser("import", help="import incomes/expenses from a CSV or OFX file")
+    importer.add_argument("path")
+    importer.add_argument("--username", required=True)
+    importer.add_argument("--table", choices=sorted(RECORD_LABELS), help="target table for CSV files")
+    importer.add_argument("--format", choices=["csv", "ofx"])
+    importer.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    importer.add_argument("--rejects", help="write rejected rows to this CSV file")
+    importer.add_argument("--restart", action="store_true", help="ignore any saved checkpoint")
+    importer.set_defaults(func=run_import)
+
+    exporter = subparsers.add_parser("export", help="export search or report results to CSV or Parquet")
+    exporter.add_argument("path")
+    exporter.add_argument("--username", required=True)
+    exporter.add_argument("--table", choices=sorted(RECORD_LABELS), required=True)
+    exporter.add_argument("--format", choices=EXPORT_FORMATS)
+    exporter.add_argument("--report", choices=["day", "month", "year", "custom"],
+                          help="export a report period instead of a search")
+    exporter.add_argument("--term", default="")
+    exporter.add_argument("--fields", help="comma separated fields the term is matched against")
+    exporter.add_argument("--start-date", default="")
+    exporter.add_argument("--end-date", default="")
+    exporter.add_argument("--min-amount", default="")
+    exporter.add_argument("--max-amount", default="")
+    exporter.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE)
+    exporter.set_defaults(func=run_export)
+
+    rollups = subparsers.add_parser("rebuild-rollups", help="recompute the daily/monthly report totals and balance checkpoints from the records")
+    rollups.set_defaults(func=run_rebuild_rollups)
+
+    sweeper = subparsers.add_parser("sweep-orphans", help="delete records, categories and totals of users that no longer exist")
+    sweeper.add_argument("--batch-size", type=int, default=DELETE_BATCH_SIZE)
+    sweeper.add_argument("--vacuum", action="store_true",
+                         help="rewrite the database file afterwards; also enables incremental compaction on older databases")
+    sweeper.set_defaults(func=run_sweep_orphans)
+
+    args = parser.parse_args(argv)
+    database.configure_metrics(slow_query_ms=args.slow_query_ms, slow_query_log=args.slow_query_log)
+    configure_analytics_cache(int(args.analytics_cache_mb * 2 ** 20))
+    try:
+        args.func(args)
+    finally:
+        if args.metrics:
+            database.export_metrics(args.metrics)
 
-root.mainloop()
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,361 @@
+import sys
+import json
+import base64
+import asyncio
+import datetime
+import argparse
+import binascii
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+import database
+import ledger
+
+SERVICE_WORKERS = 8
+MAX_BODY_SIZE = 16 * 1024 * 1024
+MAX_PAGE_SIZE = 1000
+STATUS_TEXT = {200: "OK", 201: "Created", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found",
+               405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+class HTTPError(Exception):
+    def __init__(self, status, payload):
+        super().__init__(status, payload)
+        self.status = status
+        self.payload = payload if isinstance(payload, dict) else {"error": payload}
+
+def authenticate_request(headers):
+    # a session token costs a dictionary lookup; Basic credentials cost a full scrypt verification
+    scheme, _, credentials = headers.get("authorization", "").partition(" ")
+    if scheme.lower() == "bearer":
+        username = ledger.session_user(credentials.strip())
+        if username is None:
+            raise HTTPError(401, "Invalid or expired session.")
+        return username
+    if scheme.lower() != "basic":
+        raise HTTPError(401, "Basic or Bearer authentication required.")
+    try:
+        username, _, password = base64.b64decode(credentials).decode("utf-8").partition(":")
+    except (binascii.Error, UnicodeDecodeError):
+        raise HTTPError(401, "Malformed credentials.")
+    if ledger.authenticate(username, password) is None:
+        raise HTTPError(401, "Invalid username or password.")
+    return username
+
+def get_record_table(query, name="table"):
+    record_table = query.get(name, "")
+    if record_table not in ledger.RECORD_LABELS:
+        raise HTTPError(400, f"'{name}' must be 'incomes' or 'expenses'.")
+    return record_table
+
+def add_records(record_table, username, query, body, headers):
+    try:
+        records = json.loads(body or b"null")
+    except ValueError:
+        raise HTTPError(400, "Body must be JSON.")
+    if isinstance(records, dict):
+        records = [records]
+    if not isinstance(records, list) or not records or not all(isinstance(record, dict) for record in records):
+        raise HTTPError(400, "Body must be a record or a non-empty list of records.")
+
+    label = ledger.RECORD_LABELS[record_table]
+    rows = [(username, str(record.get("amount", "")), str(record.get("date", "")), str(record.get(label, "")),
+             str(record.get("description", "")), str(record.get("type", ""))) for record in records]
+    currencies = [str(record.get("currency", ledger.DEFAULT_CURRENCY)) for record in records]
+    errors = ledger.validate_records(record_table, rows)
+    for index, currency in enumerate(currencies):
+        if not ledger.is_valid_currency(currency):
+            errors.setdefault(index, []).append(("currency", "Invalid currency code."))
+    if errors:
+        raise HTTPError(400, {"errors": [{"index": index, "fields": dict(field_errors)}
+                                         for index, field_errors in sorted(errors.items())]})
+
+    batches = {}
+    for row, currency in zip(rows, currencies):
+        batches.setdefault(currency, []).append(row)
+
+    save_records = ledger.save_incomes if record_table == "incomes" else ledger.save_expenses
+    alerts = []
+    with database.transaction():
+        for currency, rows in batches.items():
+            # only expenses are checked against budgets
+            alerts += save_records(rows, currency) or []
+    return 201, {"created": len(records),
+                 "alerts": [{"category": category, "month": month, "spent": str(spent), "budget": str(budget)}
+                            for _, category, month, spent, budget in alerts]}
+
+def search(username, query, body, headers):
+    record_table = get_record_table(query)
+    fields = [field for field in query.get("fields", "").split(",") if field]
+    search_query, params = ledger.build_search_query(
+        username, record_table, query.get("term", ""), fields, query.get("start_date", ""),
+        query.get("end_date", ""), query.get("min_amount", ""), query.get("max_amount", ""),
+        columns=ledger.PAGE_COLUMNS)
+
+    try:
+        limit = min(int(query.get("limit", ledger.RESULTS_PAGE_SIZE)), MAX_PAGE_SIZE)
+        after = (query["after_date"], int(query["after_id"])) if "after_id" in query else None
+    except (KeyError, ValueError):
+        raise HTTPError(400, "'limit' and 'after_id' must be integers and 'after_id' needs 'after_date'.")
+    if limit < 1:
+        # LIMIT 0 has no last row to page from, and a negative LIMIT means no limit at all
+        raise HTTPError(400, "'limit' must be at least 1.")
+    rows = ledger.fetch_cached_page(username, search_query, params, after=after, page_size=limit)
+
+    columns = ("id",) + ledger.RECORD_COLUMNS[record_table]
+    records = [dict(zip(columns, (row[0], row[2], ledger.format_amount(row[3])) + tuple(row[4:]))) for row in rows]
+    # keyset cursor for the next page, same (date, id) order the GUI pages through
+    next_page = {"after_date": rows[-1][1], "after_id": rows[-1][0]} if len(rows) == limit else None
+    return 200, {"records": records, "next": next_page}
+
+def report(username, query, body, headers):
+    record_table = get_record_table(query)
+    filter_type = query.get("filter", "month")
+    start_date, end_date = query.get("start_date", ""), query.get("end_date", "")
+    currency = query.get("currency", ledger.DEFAULT_CURRENCY)
+    if not ledger.is_valid_currency(currency):
+        raise HTTPError(400, "Invalid currency code.")
+    start, end = ledger.get_report_range(filter_type, start_date, end_date)
+    total = ledger.report_total(username, record_table, filter_type, start_date, end_date, currency)
+    # amounts travel as strings so JSON clients never round them through a float
+    return 200, {"table": record_table, "start_date": start.isoformat(), "end_date": end.isoformat(),
+                 "currency": currency, "total": str(total)}
+
+def trends(username, query, body, headers):
+    currency = query.get("currency", ledger.DEFAULT_CURRENCY)
+    if not ledger.is_valid_currency(currency):
+        raise HTTPError(400, "Invalid currency code.")
+    start, end = ledger.get_report_range(query.get("filter", "year"), query.get("start_date", ""),
+                                         query.get("end_date", ""))
+    report = ledger.grouped_report(username, start, end, query.get("period", "month"), query.get("group_by", "none"),
+                                   query.get("min_amount", ""), query.get("max_amount", ""), currency)
+    text = lambda value: None if value is None else str(value)
+    lines = [{"table": line["record_table"], "group": line["group"], "values": [str(value) for value in line["values"]],
+              "total": str(line["total"]), "count": line["count"], "share": text(line["share"])}
+             for line in report["lines"]]
+    return 200, {"start_date": start.isoformat(), "end_date": end.isoformat(), "currency": currency,
+                 "periods": report["periods"], "lines": lines,
+                 **{key: [str(value) for value in report[key]] for key in ("incomes", "expenses", "net")},
+                 **{key: {table: text(value) for table, value in report[key].items()}
+                    for key in ("totals", "overall_totals", "proportions")},
+                 "balance": str(report["balance"]), "balances": [str(value) for value in report["balances"]]}
+
+def balance(username, query, body, headers):
+    currency = query.get("currency", ledger.DEFAULT_CURRENCY)
+    if not ledger.is_valid_currency(currency):
+        raise HTTPError(400, "Invalid currency code.")
+    day = ledger.parse_date(query["date"]) if "date" in query else datetime.date.today()
+    if day is None:
+        raise HTTPError(400, "'date' must be a date.")
+    return 200, {"date": day.isoformat(), "currency": currency,
+                 "balance": str(ledger.balance_on(username, day, currency))}
+
+def list_recurring_rules(username, query, body, headers):
+    record_table = get_record_table(query) if "table" in query else None
+    rules = [{"id": rule_id, "table": table, "amount": ledger.format_amount(cents), ledger.RECORD_LABELS[table]: label,
+              "description": description, "type": type_, "currency": currency, "frequency": frequency,
+              "start_date": first.isoformat(), "end_date": last and last.isoformat()}
+             for rule_id, table, cents, _, label, description, type_, currency, frequency, first, last
+             in ledger.load_recurring_rules(username, record_table)]
+    return 200, {"rules": rules}
+
+def add_recurring_rule(username, query, body, headers):
+    try:
+        rule = json.loads(body or b"null")
+    except ValueError:
+        raise HTTPError(400, "Body must be JSON.")
+    if not isinstance(rule, dict):
+        raise HTTPError(400, "Body must be a rule.")
+    record_table = get_record_table(rule)
+    currency = str(rule.get("currency", ledger.DEFAULT_CURRENCY))
+    if not ledger.is_valid_currency(currency):
+        raise HTTPError(400, "Invalid currency code.")
+    label = ledger.RECORD_LABELS[record_table]
+    record = (username, str(rule.get("amount", "")), str(rule.get("start_date", "")), str(rule.get(label, "")),
+              str(rule.get("description", "")), str(rule.get("type", "")))
+    rule_id = ledger.save_recurring_rule(record_table, record, str(rule.get("frequency", "")),
+                                         str(rule.get("end_date") or ""), currency)
+    return 201, {"id": rule_id}
+
+def delete_recurring_rule(username, query, body, headers):
+    try:
+        rule_id = int(query["id"])
+    except (KeyError, ValueError):
+        raise HTTPError(400, "'id' must be an integer.")
+    if "end_date" in query:
+        # ends the rule instead, keeping the occurrences up to the end date
+        ledger.end_recurring_rule(username, rule_id, query["end_date"])
+        return 200, {"status": "ended"}
+    ledger.delete_recurring_rule(username, rule_id)
+    return 200, {"status": "deleted"}
+
+def budgets(username, query, body, headers):
+    currency = query.get("currency", ledger.DEFAULT_CURRENCY)
+    if not ledger.is_valid_currency(currency):
+        raise HTTPError(400, "Invalid currency code.")
+    month = query.get("month") or None
+    if month:
+        # the rollups key months as YYYY-MM, so "2024-1" has to be padded before it is looked up
+        day = ledger.iso_date(month + "-01")
+        if day is None:
+            raise HTTPError(400, "'month' must be YYYY-MM.")
+        month = day[:7]
+    status = ledger.budget_status(username, month, currency)
+    return 200, {"currency": currency, "budgets": [{"category": category, "budget": str(budget), "spent": str(spent),
+                                                    "remaining": str(remaining)}
+                                                   for category, budget, spent, remaining in status]}
+
+def set_budget(username, query, body, headers):
+    try:
+        budget = json.loads(body or b"null")
+    except ValueError:
+        raise HTTPError(400, "Body must be JSON.")
+    if not isinstance(budget, dict):
+        raise HTTPError(400, "Body must be a budget.")
+    currency = str(budget.get("currency", ledger.DEFAULT_CURRENCY))
+    if not ledger.is_valid_currency(currency):
+        raise HTTPError(400, "Invalid currency code.")
+    ledger.set_budget(username, str(budget.get("category", "")), str(budget.get("amount", "")), currency)
+    return 200, {"status": "set"}
+
+def remove_budget(username, query, body, headers):
+    ledger.remove_budget(username, query.get("category", ""), query.get("currency", ledger.DEFAULT_CURRENCY))
+    return 200, {"status": "removed"}
+
+def start_session(username, query, body, headers):
+    return 201, {"token": ledger.create_session(username), "expires_in": ledger.SESSION_TTL}
+
+def end_session(username, query, body, headers):
+    scheme, _, token = headers.get("authorization", "").partition(" ")
+    if scheme.lower() == "bearer":
+        ledger.end_session(token.strip())
+    return 200, {"status": "ended"}
+
+def health(username, query, body, headers):
+    return 200, {"status": "ok"}
+
+def metrics(username, query, body, headers):
+    # query shapes carry no literals, so the snapshot never exposes another user's data
+    return 200, database.metrics_snapshot()
+
+# path -> method -> (handler, needs authentication)
+ROUTES = {
+    "/health": {"GET": (health, False)},
+    "/metrics": {"GET": (metrics, True)},
+    "/sessions": {"POST": (start_session, True), "DELETE": (end_session, True)},
+    "/incomes": {"POST": (functools.partial(add_records, "incomes"), True)},
+    "/expenses": {"POST": (functools.partial(add_records, "expenses"), True)},
+    "/search": {"GET": (search, True)},
+    "/report": {"GET": (report, True)},
+    "/trends": {"GET": (trends, True)},
+    "/balance": {"GET": (balance, True)},
+    "/budgets": {"GET": (budgets, True), "PUT": (set_budget, True), "DELETE": (remove_budget, True)},
+    "/recurring": {"GET": (list_recurring_rules, True), "POST": (add_recurring_rule, True),
+                   "DELETE": (delete_recurring_rule, True)},
+}
+
+def handle_request(method, target, headers, body):
+    # runs on a worker thread: authentication and the handlers all touch the database
+    url = urlsplit(target)
+    methods = ROUTES.get(url.path)
+    if methods is None:
+        return 404, {"error": "Not found."}
+    if method not in methods:
+        return 405, {"error": "Use {}.".format(" or ".join(methods))}
+    handler, needs_auth = methods[method]
+    query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+    try:
+        with database.tagged("api" + url.path):
+            username = authenticate_request(headers) if needs_auth else None
+            return handler(username, query, body, headers)
+    except HTTPError as error:
+        return error.status, error.payload
+    except ValueError as error:
+        return 400, {"error": str(error)}
+    except Exception as error:
+        print(f"{method} {target} failed: {error!r}", file=sys.stderr)
+        return 500, {"error": "Internal error."}
+
+async def read_request(reader):
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, target, version = request_line.decode("latin-1").split()
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0))
+    if length > MAX_BODY_SIZE:
+        raise HTTPError(413, "Request body too large.")
+    body = await reader.readexactly(length) if length else b""
+    return method, target, version, headers, body
+
+def write_response(writer, status, payload, keep_alive):
+    data = json.dumps(payload).encode("utf-8")
+    head = (f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(data)}\r\n")
+    if not keep_alive:
+        head += "Connection: close\r\n"
+    writer.write(head.encode("latin-1") + b"\r\n" + data)
+
+async def handle_connection(reader, writer):
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            try:
+                request = await read_request(reader)
+            except HTTPError as error:
+                write_response(writer, error.status, error.payload, False)
+                break
+            except ValueError:
+                write_response(writer, 400, {"error": "Malformed request."}, False)
+                break
+            if request is None:
+                break
+            method, target, version, headers, body = request
+            keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+            status, payload = await loop.run_in_executor(None, handle_request, method, target, headers, body)
+            write_response(writer, status, payload, keep_alive)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def serve(host, port, workers=SERVICE_WORKERS):
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=workers))
+    server = await asyncio.start_server(handle_connection, host, port)
+    print(f"Serving on http://{host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Finance manager JSON service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--db", help="database file (default: %(default)s)", default=database.DATABASE_PATH)
+    parser.add_argument("--workers", type=int, default=SERVICE_WORKERS)
+    parser.add_argument("--slow-query-ms", type=float, default=database.SLOW_QUERY_MS,
+                        help="log statements slower than this, with their query plan (default: %(default)s)")
+    parser.add_argument("--slow-query-log", help="append slow statements to this file as JSON lines")
+    parser.add_argument("--analytics-cache-mb", type=float, default=0,
+                        help="keep whole ledgers of recently reported users in memory, up to this size (default: off)")
+    args = parser.parse_args(argv)
+
+    database.configure(args.db, size=args.workers)
+    database.configure_metrics(slow_query_ms=args.slow_query_ms, slow_query_log=args.slow_query_log)
+    ledger.configure_analytics_cache(int(args.analytics_cache_mb * 2 ** 20))
+    try:
+        asyncio.run(serve(args.host, args.port, args.workers))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main(sys.argv[1:])